@@ -6,7 +6,9 @@ Replaces OpenAI API scoring with local PyTorch EfficientNet model.
 import os
 import sys
 import io
-import base64
+import asyncio
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import Optional
 
@@ -14,18 +16,34 @@ print("=== ML Scoring API Starting ===", flush=True)
 print(f"Python version: {sys.version}", flush=True)
 print(f"Working directory: {os.getcwd()}", flush=True)
 
-from fastapi import FastAPI, HTTPException, UploadFile, File, Form
+from cachetools import LRUCache
+from fastapi import FastAPI, HTTPException, UploadFile, File, Form, Request, Depends
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel
 print("FastAPI imported", flush=True)
 
+import numpy as np
 import torch
 print(f"PyTorch version: {torch.__version__}", flush=True)
 import torch.nn as nn
+import torch.nn.functional as F
 from torchvision import transforms
+from torchvision.io import decode_jpeg, ImageReadMode
 print("torchvision imported", flush=True)
 from PIL import Image
 import timm
+
+try:
+    import pybase64 as base64  # SIMD base64 decoder, same API as the stdlib module
+except ImportError:
+    import base64
+
+try:
+    import onnxruntime as ort
+    print(f"ONNX Runtime version: {ort.__version__}", flush=True)
+except ImportError:
+    ort = None
 print("All imports complete", flush=True)
 
 # ============================================================================
@@ -34,8 +52,30 @@ print("All imports complete", flush=True)
 
 MODEL_DIR = Path(__file__).parent.parent / "model_output"
 MODEL_PATH = MODEL_DIR / "best_model.pth"
+# Backend order in load_model():
+#   1. ONNX Runtime, if facial_scorer.onnx is at least as new as best_model.pth
+#      and ORT has a TensorRT/CUDA provider (or USE_ONNX=1 opts in on CPU)
+#   2. PyTorch on CUDA: FP16, channels_last, torch.compile
+#   3. PyTorch on CPU: INT8 if best_model_int8.pth matches the checkpoint, else FP32
+ONNX_FILENAME = "facial_scorer.onnx"
+INT8_FILENAME = "best_model_int8.pth"  # See quantize_model.py
+QUANTIZED_ENGINE = "x86"
+USE_ONNX = os.getenv("USE_ONNX", "").lower() in ("1", "true", "yes")
+ONNX_GPU_PROVIDERS = {"TensorrtExecutionProvider", "CUDAExecutionProvider"}
+
+# ONNX Runtime providers in order of preference (unavailable ones are skipped)
+ONNX_PROVIDERS = [
+    ("TensorrtExecutionProvider", {
+        "trt_fp16_enable": True,
+        "trt_engine_cache_enable": True,
+        "trt_engine_cache_path": str(MODEL_DIR / "trt_cache"),
+    }),
+    "CUDAExecutionProvider",
+    "CPUExecutionProvider",
+]
 
 MODEL_NAME = "efficientnet_b0"
+MODEL_VERSION = "efficientnet_b0_v1"
 IMAGE_SIZE = 224
 NUM_METRICS = 7
 METRICS = [
@@ -47,6 +87,22 @@ METRICS = [
     "skin_quality",
     "sexual_dimorphism",
 ]
+METRICS_TUPLE = tuple(METRICS)
+NORM_MEAN = [0.485, 0.456, 0.406]
+NORM_STD = [0.229, 0.224, 0.225]
+JPEG_MAGIC = b"\xff\xd8\xff"
+
+# Dynamic batching: concurrent requests are fused into one forward pass
+MAX_BATCH_SIZE = 16
+BATCH_TIMEOUT_S = 0.005  # How long to wait for more requests after the first
+
+# Batches are padded to these sizes on CUDA so each gets one captured graph
+COMPILED_BATCH_SIZES = [2 ** i for i in range(MAX_BATCH_SIZE.bit_length()) if 2 ** i <= MAX_BATCH_SIZE]
+WARMUP_ITERS = 3
+
+# The model is deterministic, so repeat uploads (retries, UI refreshes) are
+# answered from a cache keyed on a hash of the image bytes
+SCORE_CACHE_SIZE = 4096
 
 # ============================================================================
 # Model Definition (must match train_model.py)
@@ -79,29 +135,142 @@ class FacialScoreModel(nn.Module):
         features = self.backbone(x)
         return self.head(features)
 
+class OnnxScoreModel:
+    """ONNX Runtime session with the same call signature as FacialScoreModel."""
+
+    def __init__(self, onnx_path: Path):
+        available = set(ort.get_available_providers())
+        providers = [
+            p for p in ONNX_PROVIDERS
+            if (p[0] if isinstance(p, tuple) else p) in available
+        ]
+        self.session = ort.InferenceSession(str(onnx_path), providers=providers)
+        self.input_name = self.session.get_inputs()[0].name
+
+    def __call__(self, batch: torch.Tensor) -> torch.Tensor:
+        inputs = np.ascontiguousarray(batch.float().cpu().numpy())
+        output = self.session.run(None, {self.input_name: inputs})[0]
+        return torch.from_numpy(output)
+
 # ============================================================================
 # Global Model Instance
 # ============================================================================
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+# Split the cores between uvicorn workers so intra-op threads don't contend.
+# The affinity mask reflects container CPU limits (cpuset); cpu_count is the host's.
+num_workers = int(os.getenv("WEB_CONCURRENCY", "1"))
+if device.type == "cpu" and num_workers > 1:
+    available_cpus = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else (os.cpu_count() or 1)
+    torch.set_num_threads(max(1, available_cpus // num_workers))
+# EfficientNet-B0 + sigmoid head is numerically fine in FP16 on TensorCores
+model_dtype = torch.float16 if device.type == "cuda" else torch.float32
 model: Optional[FacialScoreModel] = None
+model_compiled = False
+# Forward passes run here so they don't block the event loop. One thread keeps
+# batches serialized (they share an input buffer) and keeps CUDA graphs
+# captured at startup on the thread that replays them.
+inference_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="inference")
 
 def get_inference_transform():
     """Get inference transforms (no augmentation)."""
     return transforms.Compose([
         transforms.Resize((IMAGE_SIZE, IMAGE_SIZE)),
         transforms.ToTensor(),
-        transforms.Normalize(
-            mean=[0.485, 0.456, 0.406],
-            std=[0.229, 0.224, 0.225]
-        ),
+        transforms.Normalize(mean=NORM_MEAN, std=NORM_STD),
     ])
 
 transform = get_inference_transform()
+# Normalization constants live on the device; std is stored as a reciprocal
+# so normalization is a multiply instead of a divide
+norm_mean = torch.tensor(NORM_MEAN, device=device).view(1, 3, 1, 1)
+norm_inv_std = (1.0 / torch.tensor(NORM_STD, device=device)).view(1, 3, 1, 1)
+preprocess_stream = torch.cuda.Stream() if device.type == "cuda" else None
+
+def normalize_on_device(image: torch.Tensor) -> torch.Tensor:
+    """Resize and normalize a uint8 (3, H, W) tensor on its own device."""
+    batch = image.unsqueeze(0).float().mul_(1.0 / 255)
+    batch = F.interpolate(
+        batch, size=(IMAGE_SIZE, IMAGE_SIZE), mode="bilinear", antialias=True, align_corners=False
+    )
+    return batch.sub_(norm_mean).mul_(norm_inv_std).squeeze(0)
+
+def decode_pil(image_bytes: bytes) -> Image.Image:
+    """Decode image bytes to an RGB PIL image."""
+    image = Image.open(io.BytesIO(image_bytes))
+    # Let libjpeg downscale large JPEGs during IDCT (no-op for other formats)
+    image.draft("RGB", (IMAGE_SIZE * 2, IMAGE_SIZE * 2))
+    return image.convert("RGB")
+
+def preprocess_image(image_bytes: bytes) -> torch.Tensor:
+    """Decode image bytes into a normalized (3, H, W) model input."""
+    if device.type != "cuda":
+        return transform(decode_pil(image_bytes))
+
+    # Queue decode/H2D on a side stream so it overlaps the running forward
+    with torch.cuda.stream(preprocess_stream):
+        pixels = None
+        if image_bytes[:3] == JPEG_MAGIC:
+            # nvJPEG decode; the read-only buffer is never written to
+            data = torch.frombuffer(image_bytes, dtype=torch.uint8)
+            try:
+                pixels = decode_jpeg(data, mode=ImageReadMode.RGB, device=device)
+            except RuntimeError:
+                pass  # CMYK, truncated or otherwise unsupported by nvJPEG: PIL handles these
+        if pixels is None:
+            # PNG/WebP (or JPEG fallback): ship uint8 pixels (4x smaller than float) to the GPU
+            pixels = torch.from_numpy(np.array(decode_pil(image_bytes), dtype=np.uint8)).pin_memory()
+            pixels = pixels.to(device, non_blocking=True).permute(2, 0, 1)
+        return normalize_on_device(pixels)
+
+def fold_head_dropout(float_model: FacialScoreModel):
+    """Replace eval-mode (identity) Dropout layers in the head in place."""
+    for i, layer in enumerate(float_model.head):
+        if isinstance(layer, nn.Dropout):
+            float_model.head[i] = nn.Identity()
+
+def build_quantized_model(float_model):
+    """Rebuild the INT8 graph from quantize_model.py so its state dict loads."""
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+    torch.backends.quantized.engine = QUANTIZED_ENGINE
+    example_inputs = (torch.zeros(1, 3, IMAGE_SIZE, IMAGE_SIZE),)
+    prepared = prepare_fx(float_model, get_default_qconfig_mapping(QUANTIZED_ENGINE), example_inputs)
+    return convert_fx(prepared)
+
+def compile_model(eager_model):
+    """Compile with CUDA graphs and warm up every padded batch size."""
+    compiled = torch.compile(eager_model, mode="reduce-overhead", fullgraph=True, dynamic=False)
+
+    # Trigger Inductor codegen + graph capture before serving traffic
+    with torch.inference_mode():
+        for batch_size in COMPILED_BATCH_SIZES:
+            dummy = torch.zeros(batch_size, 3, IMAGE_SIZE, IMAGE_SIZE, device=device, dtype=model_dtype)
+            dummy = dummy.to(memory_format=torch.channels_last)
+            for _ in range(WARMUP_ITERS):
+                compiled(dummy)
+        torch.cuda.synchronize()
+
+    return compiled
+
+def should_use_onnx(onnx_path: Path, model_path: Path) -> bool:
+    """Use the ONNX export only if it is current and ORT would run it on the GPU (or USE_ONNX is set)."""
+    if ort is None or not onnx_path.exists():
+        return False
+    if onnx_path.stat().st_mtime < model_path.stat().st_mtime:
+        # train_model.py keeps the old export when re-exporting fails
+        print(f"WARNING: {onnx_path.name} is older than {model_path.name}, ignoring it", flush=True)
+        return False
+    if not ONNX_GPU_PROVIDERS & set(ort.get_available_providers()) and not USE_ONNX:
+        print("ONNX Runtime has no GPU provider, using PyTorch (set USE_ONNX=1 to override)", flush=True)
+        return False
+    return True
 
 def load_model():
     """Load the trained model."""
-    global model
+    global model, model_compiled
     if model is not None:
         return model
 
@@ -124,6 +293,16 @@ def load_model():
         print(f"ERROR: Model not found at any path!", flush=True)
         raise RuntimeError(f"Model not found. Tried: {possible_paths}")
 
+    onnx_path = model_path.with_name(ONNX_FILENAME)
+    if should_use_onnx(onnx_path, model_path):
+        print(f"Loading ONNX model from: {onnx_path}", flush=True)
+        try:
+            model = OnnxScoreModel(onnx_path)
+            print(f"ONNX Runtime providers: {model.session.get_providers()}", flush=True)
+            return model
+        except Exception as e:
+            print(f"ERROR loading ONNX model, falling back to PyTorch: {e}", flush=True)
+
     print(f"Loading model from: {model_path}", flush=True)
     try:
         model = FacialScoreModel(pretrained=False)
@@ -135,20 +314,164 @@ def load_model():
         model.load_state_dict(checkpoint["model_state_dict"])
         print("State dict loaded", flush=True)
 
-        model = model.to(device)
+        model = model.to(device, dtype=model_dtype)
         model.eval()
 
+        int8_path = model_path.with_name(INT8_FILENAME)
+        if device.type == "cpu" and int8_path.exists():
+            int8_checkpoint = torch.load(int8_path, map_location=device, weights_only=False)
+            # quantize_model.py records the epoch it quantized; a retrain makes the INT8 file stale
+            if (
+                int8_checkpoint.get("epoch") != checkpoint["epoch"]
+                or int8_path.stat().st_mtime < model_path.stat().st_mtime
+            ):
+                print(
+                    f"WARNING: {int8_path.name} does not match {model_path.name} "
+                    f"(re-run quantize_model.py), using FP32",
+                    flush=True,
+                )
+            else:
+                model = build_quantized_model(model)
+                model.load_state_dict(int8_checkpoint["model_state_dict"])
+                print(f"INT8 model loaded from: {int8_path}", flush=True)
+
+        model = model.to(memory_format=torch.channels_last)
+
+        # The INT8 graph must match quantize_model.py, so only the float
+        # model has its head simplified. Scripting is skipped on CUDA where
+        # Inductor fuses the head instead (dynamo can't trace ScriptModules).
+        if isinstance(model, FacialScoreModel):
+            fold_head_dropout(model)
+            if device.type == "cpu":
+                model.head = torch.jit.script(model.head)
+
+        # Input shape is fixed, so let cuDNN autotune conv algorithms once
+        torch.backends.cudnn.benchmark = True
+
+        # reduce-overhead relies on CUDA graphs; CPU stays eager
+        if device.type == "cuda":
+            try:
+                model = compile_model(model)
+                model_compiled = True
+                print(f"Model compiled for batch sizes {COMPILED_BATCH_SIZES}", flush=True)
+            except Exception as e:
+                print(f"torch.compile failed, using eager model: {e}", flush=True)
+
         print(f"Model loaded successfully (epoch {checkpoint['epoch'] + 1})", flush=True)
-        print(f"Device: {device}", flush=True)
+        print(f"Device: {device} ({model_dtype})", flush=True)
         return model
     except Exception as e:
         print(f"ERROR loading model: {e}", flush=True)
         raise
 
+# ============================================================================
+# Dynamic Batching
+# ============================================================================
+
+class BatchInferencer:
+    """Collects concurrent inference requests and runs them as one batch."""
+
+    def __init__(self, model, max_batch_size=MAX_BATCH_SIZE, timeout=BATCH_TIMEOUT_S, executor=inference_executor):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.timeout = timeout
+        self.executor = executor
+        self.queue: asyncio.Queue = asyncio.Queue()
+
+        # Persistent model input, filled row by row for every batch. A single
+        # buffer is enough: forward() syncs on the scores before returning.
+        self.inputs = torch.empty(
+            max_batch_size, 3, IMAGE_SIZE, IMAGE_SIZE, device=device, dtype=model_dtype
+        ).to(memory_format=torch.channels_last)
+
+    async def submit(self, image_tensor: torch.Tensor) -> list:
+        """Queue a single (3, H, W) tensor and wait for its integer scores."""
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((image_tensor, future))
+        return await future
+
+    async def collect_batch(self) -> list:
+        """Wait for one request, then gather more until full or timed out."""
+        batch = [await self.queue.get()]
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.timeout
+
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+
+        return batch
+
+    def padded_size(self, batch_size: int) -> int:
+        """Round up to the next compiled (power-of-two) batch size."""
+        return min(1 << (batch_size - 1).bit_length(), self.max_batch_size)
+
+    @staticmethod
+    def to_scores(output: torch.Tensor) -> list:
+        """Convert a batch of 0-1 outputs to rows of 0-100 integer scores."""
+        # One rounding pass per batch; .tolist() on an int tensor skips numpy
+        scores = (output.float() * 100).round_().clamp_(0, 100).to(torch.int64)
+        return scores.tolist()
+
+    def forward(self, tensors) -> list:
+        """Run one batched forward pass and return integer scores per row."""
+        model = self.model
+        batch_size = len(tensors)
+        if preprocess_stream is not None:
+            # Inputs were produced on the preprocessing stream
+            compute_stream = torch.cuda.current_stream()
+            compute_stream.wait_stream(preprocess_stream)
+            for tensor in tensors:
+                tensor.record_stream(compute_stream)
+
+        if isinstance(model, OnnxScoreModel):
+            # ONNX Runtime handles its own device placement
+            return self.to_scores(model(torch.stack(tensors)))
+
+        # Reuse a captured graph instead of recompiling for odd sizes. Rows
+        # past batch_size hold stale inputs; they are independent in eval
+        # mode and their outputs are discarded.
+        padded = self.padded_size(batch_size) if model_compiled else batch_size
+        batch = self.inputs[:padded]
+        for row, tensor in zip(batch, tensors):
+            row.copy_(tensor, non_blocking=True)
+
+        with torch.inference_mode():
+            output = model(batch)
+            # Read out immediately: CUDA graph replays reuse the output buffer
+            return self.to_scores(output[:batch_size])
+
+    async def run(self):
+        """Background loop: batch queued requests and scatter the results."""
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self.collect_batch()
+            tensors, futures = zip(*batch)
+
+            try:
+                outputs = await loop.run_in_executor(self.executor, self.forward, tensors)
+            except Exception as e:
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            for future, output in zip(futures, outputs):
+                if not future.done():
+                    future.set_result(output)
+
 # ============================================================================
 # API Models
 # ============================================================================
 
+# Score routes return plain dicts (serialized by orjson); these models only
+# document the response schema in OpenAPI
+
 class Scores(BaseModel):
     jawline: int
     cheekbones: int
@@ -160,7 +483,7 @@ class Scores(BaseModel):
 
 class ScoreResponse(BaseModel):
     scores: Scores
-    modelVersion: str = "efficientnet_b0_v1"
+    modelVersion: str = MODEL_VERSION
 
 class HealthResponse(BaseModel):
     status: str
@@ -174,7 +497,8 @@ class HealthResponse(BaseModel):
 app = FastAPI(
     title="Facial Scoring ML API",
     description="EfficientNet-B0 model for facial feature scoring",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=ORJSONResponse,
 )
 
 app.add_middleware(
@@ -190,7 +514,12 @@ async def startup_event():
     """Load model on startup."""
     print("=== Startup event triggered ===", flush=True)
     try:
-        load_model()
+        # Load (and compile/warm up) on the inference thread that will run the model
+        app.state.model = await asyncio.get_running_loop().run_in_executor(inference_executor, load_model)
+        batcher = BatchInferencer(app.state.model)
+        app.state.batcher_task = asyncio.create_task(batcher.run())
+        # Set last: routes treat the batcher as the readiness signal
+        app.state.batcher = batcher
         print("=== Startup complete ===", flush=True)
     except Exception as e:
         print(f"=== Startup FAILED: {e} ===", flush=True)
@@ -199,8 +528,8 @@ async def startup_event():
 @app.get("/health", response_model=HealthResponse)
 async def health():
     """Health check endpoint."""
-    print(f"Health check called, model loaded: {model is not None}", flush=True)
-    if model is None:
+    # Same readiness signal as get_batcher: ready once the batcher is running
+    if getattr(app.state, "batcher", None) is None:
         raise HTTPException(
             status_code=503,
             detail="Model not loaded"
@@ -216,31 +545,42 @@ async def root():
     """Root endpoint for basic connectivity test."""
     return {"status": "ok", "service": "facial-scoring-ml"}
 
-def process_image(image: Image.Image) -> dict:
-    """Process a single image and return scores."""
-    if model is None:
-        raise RuntimeError("Model not loaded")
-
-    # Ensure RGB
-    image = image.convert("RGB")
-
-    # Apply transforms
-    image_tensor = transform(image).unsqueeze(0).to(device)
-
-    # Inference
-    with torch.no_grad():
-        output = model(image_tensor)
-
-    # Convert to 0-100 scale and round to integers
-    scores_list = (output.squeeze().cpu().numpy() * 100).tolist()
-
-    return {
-        metric: int(round(score))
-        for metric, score in zip(METRICS, scores_list)
-    }
-
-@app.post("/score", response_model=ScoreResponse)
-async def score_image(image: UploadFile = File(...)):
+def decode_data_url(data_url: str) -> bytes:
+    """Decode a base64 data URL (or bare base64 string) to raw bytes."""
+    # find() returns -1 when there is no header, so the slice starts at 0
+    return base64.b64decode(data_url[data_url.find(",") + 1:], validate=False)
+
+def get_batcher(request: Request) -> BatchInferencer:
+    """Readiness gate: reject scoring requests until the model has loaded."""
+    batcher = getattr(request.app.state, "batcher", None)
+    if batcher is None:
+        raise HTTPException(status_code=503, detail="Model not loaded")
+    return batcher
+
+score_cache = LRUCache(maxsize=SCORE_CACHE_SIZE)
+
+async def process_image(batcher: BatchInferencer, image_bytes: bytes) -> dict:
+    """Process a single encoded image and return scores."""
+    cache_key = hashlib.blake2b(image_bytes, digest_size=16).digest()
+    cached = score_cache.get(cache_key)
+    if cached is not None:
+        return cached
+
+    # Decode + transform in a worker thread so the event loop keeps serving
+    image_tensor = await asyncio.to_thread(preprocess_image, image_bytes)
+
+    # Inference (batched with any concurrent requests), already 0-100 ints
+    scores_list = await batcher.submit(image_tensor)
+
+    scores = dict(zip(METRICS_TUPLE, scores_list))
+    score_cache[cache_key] = scores
+    return scores
+
+@app.post("/score", responses={200: {"model": ScoreResponse}})
+async def score_image(
+    image: UploadFile = File(...),
+    batcher: BatchInferencer = Depends(get_batcher)
+):
     """
     Score a single facial image.
 
@@ -249,18 +589,17 @@ async def score_image(image: UploadFile = File(...)):
     """
     try:
         contents = await image.read()
-        pil_image = Image.open(io.BytesIO(contents))
-        scores = process_image(pil_image)
+        scores = await process_image(batcher, contents)
 
-        return ScoreResponse(
-            scores=Scores(**scores),
-            modelVersion="efficientnet_b0_v1"
-        )
+        return {"scores": scores, "modelVersion": MODEL_VERSION}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.post("/score/base64", response_model=ScoreResponse)
-async def score_image_base64(data_url: str = Form(...)):
+@app.post("/score/base64", responses={200: {"model": ScoreResponse}})
+async def score_image_base64(
+    data_url: str = Form(...),
+    batcher: BatchInferencer = Depends(get_batcher)
+):
     """
     Score a facial image from base64 data URL.
 
@@ -268,28 +607,18 @@ async def score_image_base64(data_url: str = Form(...)):
     Returns: 7 facial metric scores (0-100 scale)
     """
     try:
-        # Parse data URL
-        if "," in data_url:
-            header, encoded = data_url.split(",", 1)
-        else:
-            encoded = data_url
-
-        # Decode base64
-        image_bytes = base64.b64decode(encoded)
-        pil_image = Image.open(io.BytesIO(image_bytes))
-        scores = process_image(pil_image)
-
-        return ScoreResponse(
-            scores=Scores(**scores),
-            modelVersion="efficientnet_b0_v1"
-        )
+        image_bytes = decode_data_url(data_url)
+        scores = await process_image(batcher, image_bytes)
+
+        return {"scores": scores, "modelVersion": MODEL_VERSION}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.post("/score/pair", response_model=ScoreResponse)
+@app.post("/score/pair", responses={200: {"model": ScoreResponse}})
 async def score_image_pair(
     frontal: UploadFile = File(...),
-    side: UploadFile = File(...)
+    side: UploadFile = File(...),
+    batcher: BatchInferencer = Depends(get_batcher)
 ):
     """
     Score using both frontal and side profile images.
@@ -303,20 +632,17 @@ async def score_image_pair(
         # For now, just use the frontal image
         # Future: Train a model that uses both views
         contents = await frontal.read()
-        pil_image = Image.open(io.BytesIO(contents))
-        scores = process_image(pil_image)
+        scores = await process_image(batcher, contents)
 
-        return ScoreResponse(
-            scores=Scores(**scores),
-            modelVersion="efficientnet_b0_v1"
-        )
+        return {"scores": scores, "modelVersion": MODEL_VERSION}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.post("/score/pair-bytes", response_model=ScoreResponse)
+@app.post("/score/pair-bytes", responses={200: {"model": ScoreResponse}})
 async def score_pair_bytes(
     front: str = Form(...),
-    side: str = Form(...)
+    side: str = Form(...),
+    batcher: BatchInferencer = Depends(get_batcher)
 ):
     """
     Score using base64 data URLs for frontal and side images.
@@ -324,20 +650,11 @@ async def score_pair_bytes(
     Note: Current model only uses frontal image.
     """
     try:
-        # Parse frontal data URL
-        if "," in front:
-            _, encoded = front.split(",", 1)
-        else:
-            encoded = front
-
-        image_bytes = base64.b64decode(encoded)
-        pil_image = Image.open(io.BytesIO(image_bytes))
-        scores = process_image(pil_image)
-
-        return ScoreResponse(
-            scores=Scores(**scores),
-            modelVersion="efficientnet_b0_v1"
-        )
+        # Only the frontal data URL is scored
+        image_bytes = decode_data_url(front)
+        scores = await process_image(batcher, image_bytes)
+
+        return {"scores": scores, "modelVersion": MODEL_VERSION}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -0,0 +1,41 @@
+"""
+Scored-image index shared by train_model.py and test_model.py.
+
+Builds the list of images that have scores in scores.json and exist on disk,
+pickled next to the other training caches so repeat runs skip the scan.
+"""
+
+import pickle
+from pathlib import Path
+
+IMAGE_SUFFIXES = {".jpg", ".png"}
+
+
+def get_scored_image_paths(scores_dict: dict, images_dir: Path, scores_file: Path) -> list:
+    """Paths of scored images that exist in images_dir ([] if the folder is missing).
+
+    The list comes from scores.json filtered against one listing of
+    images_dir, and is cached in <scores_file dir>/cache/image_list.pkl. It is
+    rebuilt when scores.json changes or files are added to or removed from
+    images_dir (directory mtime).
+    """
+    if not images_dir.is_dir():
+        return []
+
+    cache_file = scores_file.parent / "cache" / "image_list.pkl"
+    cache_key = (str(images_dir), scores_file.stat().st_mtime_ns, images_dir.stat().st_mtime_ns)
+    try:
+        with open(cache_file, "rb") as f:
+            cached = pickle.load(f)
+        if cached["key"] == cache_key:
+            return [images_dir / name for name in cached["filenames"]]
+    except (OSError, EOFError, KeyError, pickle.UnpicklingError):
+        pass
+
+    # One directory listing instead of a stat per scored file
+    on_disk = {p.name for p in images_dir.iterdir() if p.suffix.lower() in IMAGE_SUFFIXES}
+    filenames = [name for name in scores_dict if name in on_disk]
+    cache_file.parent.mkdir(parents=True, exist_ok=True)
+    with open(cache_file, "wb") as f:
+        pickle.dump({"key": cache_key, "filenames": filenames}, f)
+    return [images_dir / name for name in filenames]
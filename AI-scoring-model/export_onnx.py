@@ -0,0 +1,71 @@
+"""
+Export the trained facial scoring model to ONNX for serving.
+The API serves model_output/facial_scorer.onnx instead of best_model.pth when
+the export is at least as new as the checkpoint and onnxruntime-gpu is
+installed (or USE_ONNX=1 is set), so run this after every training run.
+
+For TensorRT, the API's TensorrtExecutionProvider builds and caches an FP16
+engine on first load. A standalone engine can also be built with:
+    trtexec --fp16 --onnx=model_output/facial_scorer.onnx --saveEngine=model_output/facial_scorer.engine
+"""
+
+import torch
+
+from test_model import FacialScoreModel, MODEL_PATH, IMAGE_SIZE, NUM_METRICS
+
+# ============================================================================
+# Configuration
+# ============================================================================
+
+ONNX_PATH = MODEL_PATH.with_name("facial_scorer.onnx")
+OPSET_VERSION = 17
+
+
+def export(model_path=MODEL_PATH, onnx_path=ONNX_PATH):
+    """Export the checkpoint at model_path to ONNX with a dynamic batch axis."""
+    print(f"Loading model from: {model_path}")
+    model = FacialScoreModel(pretrained=False)
+    checkpoint = torch.load(model_path, map_location="cpu", weights_only=False)
+    model.load_state_dict(checkpoint["model_state_dict"])
+    model.eval()
+
+    dummy_input = torch.zeros(1, 3, IMAGE_SIZE, IMAGE_SIZE)
+
+    print(f"Exporting to ONNX (opset {OPSET_VERSION})...")
+    torch.onnx.export(
+        model,
+        dummy_input,
+        str(onnx_path),
+        export_params=True,
+        opset_version=OPSET_VERSION,
+        do_constant_folding=True,
+        input_names=["image"],
+        output_names=["scores"],
+        dynamic_axes={
+            "image": {0: "batch_size"},
+            "scores": {0: "batch_size"},
+        },
+    )
+    print(f"Saved ONNX model: {onnx_path}")
+
+    # Sanity check against PyTorch if onnxruntime is available
+    try:
+        import onnxruntime as ort
+    except ImportError:
+        print("onnxruntime not installed, skipping verification")
+        return
+
+    check_input = torch.rand(4, 3, IMAGE_SIZE, IMAGE_SIZE)
+    with torch.inference_mode():
+        expected = model(check_input).numpy()
+
+    session = ort.InferenceSession(str(onnx_path), providers=["CPUExecutionProvider"])
+    actual = session.run(None, {"image": check_input.numpy()})[0]
+
+    assert actual.shape == (4, NUM_METRICS), f"Unexpected output shape {actual.shape}"
+    max_diff = abs(actual - expected).max() * 100
+    print(f"Max difference vs PyTorch: {max_diff:.4f} points (on 0-100 scale)")
+
+
+if __name__ == "__main__":
+    export()
@@ -6,12 +6,15 @@ Merges with existing scores to create a complete 7-metric dataset for ML trainin
 """
 
 import os
-import json
-import base64
 import time
+import asyncio
 from pathlib import Path
 from dotenv import load_dotenv
-from openai import OpenAI
+
+from labeler import (
+    AsyncLabeler, ProgressStore, RateLimiter, create_client, fully_scored_keys,
+    read_json, write_json_atomic,
+)
 
 # ============================================================================
 # Configuration
@@ -40,6 +43,15 @@ PROGRESS_FILE = Path(__file__).parent / "scoring_progress.json"
 MODEL = "gpt-4o"
 TEMPERATURE = 0.1
 
+# Concurrency config
+MAX_CONCURRENT_REQUESTS = 16  # In-flight API calls
+IMAGES_PER_REQUEST = 5  # Faces scored per call; the system prompt is sent once per call
+REPORT_EVERY = 10  # Completions between progress reports
+
+# Rate limits for the account tier (requests are throttled to stay under them)
+MAX_REQUESTS_PER_MINUTE = 500
+MAX_TOKENS_PER_MINUTE = 30000
+
 # Metrics we need to generate
 METRICS_TO_GENERATE = ["facial_symmetry", "skin_quality", "sexual_dimorphism"]
 
@@ -117,100 +129,20 @@ VARIANCE REQUIREMENT:
 - Some faces genuinely score 20s-30s, others genuinely score 90s
 - Match your score to what you actually observe
 
-OUTPUT: JSON only with exactly 3 integer keys. No text, no explanation.
-Example: {"facial_symmetry": 34, "skin_quality": 91, "sexual_dimorphism": 67}
+OUTPUT: You will receive one or more numbered images. Score each face independently.
+JSON only, mapping each image number (as a string) to an object with exactly 3 integer keys. No text, no explanation.
+Example for 2 images: {"1": {"facial_symmetry": 34, "skin_quality": 91, "sexual_dimorphism": 67}, "2": {"facial_symmetry": 78, "skin_quality": 52, "sexual_dimorphism": 29}}
 """.strip()
 
-USER_PROMPT = """Analyze this face and return scores for facial_symmetry, skin_quality, and sexual_dimorphism. Use the FULL 0-100 range based on what you observe - exceptional features can score 90+, poor features can score below 30. Return ONLY JSON with 3 integer values."""
+USER_PROMPT = """Analyze each numbered face below and return scores for facial_symmetry, skin_quality, and sexual_dimorphism for each one independently. Use the FULL 0-100 range based on what you observe - exceptional features can score 90+, poor features can score below 30. Return ONLY JSON mapping each image number to its 3 integer values."""
 
 # ============================================================================
 # Helper Functions
 # ============================================================================
 
-def encode_image_to_base64(image_path: Path) -> str:
-    """Read image and encode to base64 data URL."""
-    with open(image_path, "rb") as f:
-        data = f.read()
-
-    # Determine mime type
-    suffix = image_path.suffix.lower()
-    mime_map = {".jpg": "image/jpeg", ".jpeg": "image/jpeg", ".png": "image/png"}
-    mime = mime_map.get(suffix, "image/jpeg")
-
-    b64 = base64.b64encode(data).decode("utf-8")
-    return f"data:{mime};base64,{b64}"
-
-
-def parse_scores(raw_response: str) -> dict:
-    """Parse JSON response from model, handling code fences."""
-    text = raw_response.strip()
-
-    # Strip code fences if present
-    text = text.replace("```json", "").replace("```", "").strip()
-
-    # Try direct parse
-    try:
-        data = json.loads(text)
-    except json.JSONDecodeError:
-        # Try to extract JSON object
-        start = text.find("{")
-        end = text.rfind("}") + 1
-        if start >= 0 and end > start:
-            data = json.loads(text[start:end])
-        else:
-            raise ValueError(f"Could not parse JSON from: {text[:200]}")
-
-    # Validate keys
-    for key in METRICS_TO_GENERATE:
-        if key not in data:
-            raise ValueError(f"Missing key '{key}' in response")
-        val = data[key]
-        if not isinstance(val, (int, float)):
-            raise ValueError(f"Invalid value for '{key}': {val}")
-        # Clamp to 0-100 and round
-        data[key] = max(0, min(100, round(float(val))))
-
-    return {k: data[k] for k in METRICS_TO_GENERATE}
-
-
-def score_image(client: OpenAI, image_path: Path, max_retries: int = 3) -> dict:
-    """Call OpenAI API to score a single image for the 3 missing metrics."""
-    data_url = encode_image_to_base64(image_path)
-
-    for attempt in range(max_retries):
-        try:
-            response = client.chat.completions.create(
-                model=MODEL,
-                temperature=TEMPERATURE,
-                response_format={"type": "json_object"},
-                messages=[
-                    {"role": "system", "content": SYSTEM_PROMPT},
-                    {
-                        "role": "user",
-                        "content": [
-                            {"type": "text", "text": USER_PROMPT},
-                            {"type": "image_url", "image_url": {"url": data_url}},
-                        ],
-                    },
-                ],
-            )
-
-            raw = response.choices[0].message.content
-            scores = parse_scores(raw)
-            return scores
-
-        except Exception as e:
-            print(f"  Attempt {attempt + 1} failed: {e}")
-            if attempt < max_retries - 1:
-                time.sleep(2 ** attempt)  # Exponential backoff
-            else:
-                raise
-
-
 def load_existing_scores() -> dict:
     """Load and transform existing scores from the 4-metrics file."""
-    with open(EXISTING_SCORES_FILE, "r") as f:
-        data = json.load(f)
+    data = read_json(EXISTING_SCORES_FILE)
 
     existing = {}
     for filename, scores in data["scores"].items():
@@ -224,20 +156,6 @@ def load_existing_scores() -> dict:
     return existing
 
 
-def load_progress() -> dict:
-    """Load progress file if it exists."""
-    if PROGRESS_FILE.exists():
-        with open(PROGRESS_FILE, "r") as f:
-            return json.load(f)
-    return {"completed": {}, "failed": []}
-
-
-def save_progress(progress: dict):
-    """Save progress to file."""
-    with open(PROGRESS_FILE, "w") as f:
-        json.dump(progress, f, indent=2)
-
-
 def save_final_output(all_scores: dict):
     """Save final output in ML-training-friendly format."""
     # Create list format for easy loading with pandas/numpy
@@ -267,8 +185,7 @@ def save_final_output(all_scores: dict):
         "data": data_list,
     }
 
-    with open(OUTPUT_FILE, "w") as f:
-        json.dump(output, f, indent=2)
+    write_json_atomic(OUTPUT_FILE, output, pretty=True)
 
     print(f"\nSaved complete scores to: {OUTPUT_FILE}")
 
@@ -277,14 +194,16 @@ def save_final_output(all_scores: dict):
 # Main
 # ============================================================================
 
-def main():
+def describe_scores(s: dict) -> str:
+    """The 3 generated scores for the progress line."""
+    return f"OK - facial_sym={s['facial_symmetry']}, skin={s['skin_quality']}, sex_dim={s['sexual_dimorphism']}"
+
+
+async def main():
     print("=" * 60)
     print("Facial Metrics Generator")
     print("=" * 60)
 
-    # Initialize OpenAI client
-    client = OpenAI(api_key=OPENAI_API_KEY)
-
     # Load existing scores
     print(f"\nLoading existing scores from: {EXISTING_SCORES_FILE}")
     existing_scores = load_existing_scores()
@@ -298,68 +217,69 @@ def main():
     print(f"\nFound {len(image_files)} images in: {DATASET_DIR}")
 
     # Load progress
-    progress = load_progress()
-    completed = progress["completed"]
+    store = ProgressStore(PROGRESS_FILE)
+    completed = store.completed_keys()
     print(f"  Already completed: {len(completed)} images")
 
-    # Merge existing scores with progress
-    all_scores = {}
-    for filename, scores in existing_scores.items():
-        all_scores[filename] = scores.copy()
-        if filename in completed:
-            all_scores[filename].update(completed[filename])
+    # Skip images already written to the output with the generated metrics,
+    # even if the progress file lost them
+    completed |= fully_scored_keys(OUTPUT_FILE, METRICS_TO_GENERATE)
 
     # Process images
-    remaining = [f for f in image_files if f.name not in completed]
-    print(f"\nProcessing {len(remaining)} remaining images...")
+    remaining = [(f.name, f) for f in image_files if f.name not in completed]
+    print(f"\nProcessing {len(remaining)} remaining images ({MAX_CONCURRENT_REQUESTS} in flight, {IMAGES_PER_REQUEST} per request)...")
     print("-" * 60)
 
-    for i, image_path in enumerate(remaining):
-        filename = image_path.name
-        print(f"[{i+1}/{len(remaining)}] {filename}", end=" ... ", flush=True)
-
-        try:
-            # Score the image
-            new_scores = score_image(client, image_path)
-
-            # Merge with existing
-            if filename not in all_scores:
-                all_scores[filename] = existing_scores.get(filename, {}).copy()
-            all_scores[filename].update(new_scores)
-
-            # Update progress
-            completed[filename] = new_scores
-
-            print(f"OK - facial_sym={new_scores['facial_symmetry']}, skin={new_scores['skin_quality']}, sex_dim={new_scores['sexual_dimorphism']}")
-
-            # Save progress every 10 images
-            if (i + 1) % 10 == 0:
-                save_progress({"completed": completed, "failed": progress.get("failed", [])})
-                print(f"  [Progress saved: {len(completed)} completed]")
-
-            # Small delay to avoid rate limits
-            time.sleep(0.5)
-
-        except Exception as e:
-            print(f"FAILED - {e}")
-            if filename not in progress.get("failed", []):
-                progress.setdefault("failed", []).append(filename)
-
-    # Final save
-    save_progress({"completed": completed, "failed": progress.get("failed", [])})
-    save_final_output(all_scores)
+    # Initialize OpenAI client
+    client = create_client(OPENAI_API_KEY)
+    labeler = AsyncLabeler(
+        client,
+        RateLimiter(MAX_REQUESTS_PER_MINUTE, MAX_TOKENS_PER_MINUTE),
+        store,
+        METRICS_TO_GENERATE,
+        SYSTEM_PROMPT,
+        USER_PROMPT,
+        model=MODEL,
+        temperature=TEMPERATURE,
+        images_per_request=IMAGES_PER_REQUEST,
+        max_concurrent_requests=MAX_CONCURRENT_REQUESTS,
+        report_every=REPORT_EVERY,
+        describe=describe_scores,
+    )
+    try:
+        await labeler.run(remaining)
+    finally:
+        await client.close()
+
+        # Final save, also on Ctrl-C or a failed run
+        progress = store.compact()
+        completed = progress["completed"]
+
+        # Merge the previous output, existing scores and generated ones (later wins).
+        # The previous output holds generated scores for images skipped above.
+        previous_scores = read_json(OUTPUT_FILE)["scores"] if OUTPUT_FILE.exists() else {}
+        all_scores = {
+            filename: {
+                **previous_scores.get(filename, {}),
+                **existing_scores.get(filename, {}),
+                **completed.get(filename, {}),
+            }
+            for filename in existing_scores.keys() | previous_scores.keys() | completed.keys()
+        }
+        save_final_output(all_scores)
 
     # Summary
     print("\n" + "=" * 60)
     print("COMPLETE")
     print("=" * 60)
     print(f"Total images processed: {len(completed)}")
-    print(f"Failed images: {len(progress.get('failed', []))}")
+    print(f"Failed images: {len(progress['failed'])}")
+    print(f"Prompt cache: {labeler.cached_tokens}/{labeler.prompt_tokens} tokens ({labeler.cache_hit_rate():.0%})")
     print(f"Output file: {OUTPUT_FILE}")
 
-    if progress.get("failed"):
+    if progress["failed"]:
         print(f"\nFailed images: {progress['failed']}")
 
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())
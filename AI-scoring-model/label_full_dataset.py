@@ -4,12 +4,15 @@ Based on the production prompt from scorer-node but optimized for full range usa
 """
 
 import os
-import json
-import base64
 import time
+import asyncio
 from pathlib import Path
 from dotenv import load_dotenv
-from openai import OpenAI
+
+from labeler import (
+    AsyncLabeler, ProgressStore, RateLimiter, create_client, fully_scored_keys,
+    read_json, write_json_atomic,
+)
 
 # ============================================================================
 # Configuration
@@ -38,6 +41,17 @@ EXISTING_SCORES_FILE = Path(__file__).parent / "complete_scores.json"
 MODEL = "gpt-4o"
 TEMPERATURE = 0.1
 
+# Concurrency config
+MAX_CONCURRENT_REQUESTS = 16  # In-flight API calls
+IMAGES_PER_REQUEST = 5  # Faces scored per call; the system prompt is sent once per call
+REPORT_EVERY = 50  # Completions between progress reports
+
+# Rate limits for the account tier (requests are throttled to stay under them)
+MAX_REQUESTS_PER_MINUTE = 500
+MAX_TOKENS_PER_MINUTE = 30000
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+
 # All 7 metrics
 ALL_METRICS = [
     "jawline",
@@ -138,108 +152,29 @@ CRITICAL INSTRUCTIONS:
 5. Base scores purely on visible structural characteristics
 
 OUTPUT FORMAT:
-Return ONLY a valid JSON object with exactly 7 integer keys.
+You will receive one or more numbered images. Score each face independently.
+Return ONLY a valid JSON object mapping each image number (as a string) to an
+object with exactly 7 integer keys.
 No explanation, no text, no markdown - just the JSON object.
 
-Example: {"jawline": 72, "cheekbones": 84, "eyes_symmetry": 68, "nose_harmony": 55, "facial_symmetry": 71, "skin_quality": 89, "sexual_dimorphism": 77}
+Example for 2 images: {"1": {"jawline": 72, "cheekbones": 84, "eyes_symmetry": 68, "nose_harmony": 55, "facial_symmetry": 71, "skin_quality": 89, "sexual_dimorphism": 77}, "2": {"jawline": 38, "cheekbones": 45, "eyes_symmetry": 81, "nose_harmony": 62, "facial_symmetry": 49, "skin_quality": 57, "sexual_dimorphism": 33}}
 """.strip()
 
-USER_PROMPT = """Analyze this face and score all 7 metrics. Use the full 0-100 range based on what you observe - exceptional features can score 90+, weak features can score below 30. Return ONLY a JSON object with the 7 scores."""
+USER_PROMPT = """Analyze each numbered face below and score all 7 metrics for each one independently. Use the full 0-100 range based on what you observe - exceptional features can score 90+, weak features can score below 30. Return ONLY a JSON object mapping each image number to its 7 scores."""
 
 # ============================================================================
 # Helper Functions
 # ============================================================================
 
-def encode_image_to_base64(image_path: Path) -> str:
-    """Read image and encode to base64 data URL."""
-    with open(image_path, "rb") as f:
-        data = f.read()
-
-    suffix = image_path.suffix.lower()
-    mime_map = {".jpg": "image/jpeg", ".jpeg": "image/jpeg", ".png": "image/png"}
-    mime = mime_map.get(suffix, "image/jpeg")
-
-    b64 = base64.b64encode(data).decode("utf-8")
-    return f"data:{mime};base64,{b64}"
-
-
-def parse_scores(raw_response: str) -> dict:
-    """Parse JSON response from model."""
-    text = raw_response.strip()
-    text = text.replace("```json", "").replace("```", "").strip()
-
-    try:
-        data = json.loads(text)
-    except json.JSONDecodeError:
-        start = text.find("{")
-        end = text.rfind("}") + 1
-        if start >= 0 and end > start:
-            data = json.loads(text[start:end])
-        else:
-            raise ValueError(f"Could not parse JSON: {text[:200]}")
-
-    # Validate all 7 keys
-    for key in ALL_METRICS:
-        if key not in data:
-            raise ValueError(f"Missing key '{key}'")
-        val = data[key]
-        if not isinstance(val, (int, float)):
-            raise ValueError(f"Invalid value for '{key}': {val}")
-        data[key] = max(0, min(100, round(float(val))))
-
-    return {k: data[k] for k in ALL_METRICS}
-
-
-def score_image(client: OpenAI, image_path: Path, max_retries: int = 3) -> dict:
-    """Score a single image for all 7 metrics."""
-    data_url = encode_image_to_base64(image_path)
-
-    for attempt in range(max_retries):
-        try:
-            response = client.chat.completions.create(
-                model=MODEL,
-                temperature=TEMPERATURE,
-                response_format={"type": "json_object"},
-                messages=[
-                    {"role": "system", "content": SYSTEM_PROMPT},
-                    {
-                        "role": "user",
-                        "content": [
-                            {"type": "text", "text": USER_PROMPT},
-                            {"type": "image_url", "image_url": {"url": data_url}},
-                        ],
-                    },
-                ],
-            )
-
-            raw = response.choices[0].message.content
-            scores = parse_scores(raw)
-            return scores
-
-        except Exception as e:
-            print(f"  Attempt {attempt + 1} failed: {e}")
-            if attempt < max_retries - 1:
-                time.sleep(2 ** attempt)
-            else:
-                raise
-
-
-def load_progress() -> dict:
-    """Load progress file if exists."""
-    if PROGRESS_FILE.exists():
-        with open(PROGRESS_FILE, "r") as f:
-            return json.load(f)
-    return {"completed": {}, "failed": []}
-
-
-def save_progress(progress: dict):
-    """Save progress to file."""
-    with open(PROGRESS_FILE, "w") as f:
-        json.dump(progress, f)
+def save_output(scores: dict, failed: list):
+    """Save scores to output file, keeping entries already in it (scores wins on conflict).
 
+    main() skips images that are fully scored in the output but missing from
+    the progress file, so the output can't be rebuilt from progress alone.
+    """
+    if OUTPUT_FILE.exists():
+        scores = {**read_json(OUTPUT_FILE)["scores"], **scores}
 
-def save_output(scores: dict, failed: list):
-    """Save scores to output file."""
     data_list = []
     for filename in sorted(scores.keys()):
         record = {"image": filename}
@@ -260,24 +195,24 @@ def save_output(scores: dict, failed: list):
         "data": data_list,
     }
 
-    with open(OUTPUT_FILE, "w") as f:
-        json.dump(output, f, indent=2)
+    write_json_atomic(OUTPUT_FILE, output, pretty=True)
 
 
 def get_all_images(directory: Path, prefix_filter: str = None) -> list:
-    """Recursively get all images from directory (deduplicated)."""
-    seen = set()
+    """Recursively get all images from directory in a single scandir walk."""
+    prefix = prefix_filter.upper() if prefix_filter else None
     images = []
-    for ext in ["*.jpg", "*.jpeg", "*.png"]:
-        for img in directory.rglob(ext):
-            # Use lowercase name to avoid duplicates on case-insensitive systems
-            key = str(img.resolve()).lower()
-            if key not in seen:
-                # Apply prefix filter if specified
-                if prefix_filter and not img.name.upper().startswith(prefix_filter.upper()):
-                    continue
-                seen.add(key)
-                images.append(img)
+    stack = [directory]
+    while stack:
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.name.lower().endswith(IMAGE_EXTENSIONS):
+                    # Apply prefix filter if specified
+                    if prefix and not entry.name.upper().startswith(prefix):
+                        continue
+                    images.append(Path(entry.path))
     return sorted(images, key=lambda x: x.name.lower())
 
 
@@ -289,16 +224,14 @@ def combine_datasets():
 
     # Load existing scores
     if EXISTING_SCORES_FILE.exists():
-        with open(EXISTING_SCORES_FILE, "r") as f:
-            existing = json.load(f)
+        existing = read_json(EXISTING_SCORES_FILE)
         for filename, scores in existing.get("scores", {}).items():
             combined_scores[f"normalized_dataset/{filename}"] = scores
         print(f"  Loaded {len(existing.get('scores', {}))} existing scores")
 
     # Load new scores
     if OUTPUT_FILE.exists():
-        with open(OUTPUT_FILE, "r") as f:
-            new_data = json.load(f)
+        new_data = read_json(OUTPUT_FILE)
         for filename, scores in new_data.get("scores", {}).items():
             combined_scores[filename] = scores
         print(f"  Loaded {len(new_data.get('scores', {}))} new scores")
@@ -322,8 +255,7 @@ def combine_datasets():
         "data": data_list,
     }
 
-    with open(FINAL_COMBINED_FILE, "w") as f:
-        json.dump(combined, f, indent=2)
+    write_json_atomic(FINAL_COMBINED_FILE, combined, pretty=True)
 
     print(f"  Combined dataset saved: {len(data_list)} total images")
     print(f"  Output: {FINAL_COMBINED_FILE}")
@@ -333,13 +265,16 @@ def combine_datasets():
 # Main
 # ============================================================================
 
-def main():
+def describe_scores(s: dict) -> str:
+    """All 7 scores in compact format for the progress line."""
+    return f"jaw={s['jawline']} chk={s['cheekbones']} eye={s['eyes_symmetry']} nose={s['nose_harmony']} sym={s['facial_symmetry']} skin={s['skin_quality']} dim={s['sexual_dimorphism']}"
+
+
+async def main():
     print("=" * 70)
     print("Full Dataset Labeling - 7 Metrics")
     print("=" * 70)
 
-    client = OpenAI(api_key=OPENAI_API_KEY)
-
     # Get all images (filter by prefix if needed - set to None for all images)
     PREFIX_FILTER = "CM"  # Only process images starting with "CM" (set to None for all)
 
@@ -349,14 +284,19 @@ def main():
     all_images = get_all_images(IMAGES_DIR, prefix_filter=PREFIX_FILTER)
     print(f"Found {len(all_images)} images")
 
-    # Load progress
-    progress = load_progress()
-    completed = progress["completed"]
-    failed = progress.get("failed", [])
+    # Load completed keys only; scores are read back from disk when compacting at the end
+    store = ProgressStore(PROGRESS_FILE)
+    completed = store.completed_keys()
     print(f"Already completed: {len(completed)}")
 
-    # Filter remaining (use relative path as key)
-    remaining = [img for img in all_images if str(img.relative_to(IMAGES_DIR)).replace("\\", "/") not in completed]
+    # Images already in the output with all 7 metrics count as done even if the progress file lost them
+    completed |= fully_scored_keys(OUTPUT_FILE, ALL_METRICS)
+
+    # Filter remaining, keyed by relative path to handle same-name files in different folders
+    remaining = [
+        (rel_path, img) for img in all_images
+        if (rel_path := img.relative_to(IMAGES_DIR).as_posix()) not in completed
+    ]
     print(f"Remaining to process: {len(remaining)}")
 
     if not remaining:
@@ -364,44 +304,37 @@ def main():
         combine_datasets()
         return
 
+    print(f"Concurrency: {MAX_CONCURRENT_REQUESTS} requests in flight, {IMAGES_PER_REQUEST} images per request")
     print("-" * 70)
 
-    # Process images
+    # Process images concurrently
+    client = create_client(OPENAI_API_KEY)
+    labeler = AsyncLabeler(
+        client,
+        RateLimiter(MAX_REQUESTS_PER_MINUTE, MAX_TOKENS_PER_MINUTE),
+        store,
+        ALL_METRICS,
+        SYSTEM_PROMPT,
+        USER_PROMPT,
+        model=MODEL,
+        temperature=TEMPERATURE,
+        images_per_request=IMAGES_PER_REQUEST,
+        max_concurrent_requests=MAX_CONCURRENT_REQUESTS,
+        report_every=REPORT_EVERY,
+        describe=describe_scores,
+    )
     start_time = time.time()
+    try:
+        await labeler.run(remaining)
+    finally:
+        await client.close()
 
-    for i, image_path in enumerate(remaining):
-        # Use relative path as key to handle same-name files in different folders
-        rel_path = str(image_path.relative_to(IMAGES_DIR)).replace("\\", "/")
-
-        print(f"[{i+1}/{len(remaining)}] {rel_path}", end=" ... ", flush=True)
-
-        try:
-            scores = score_image(client, image_path)
-            completed[rel_path] = scores
-
-            # Show all 7 scores in compact format
-            s = scores
-            print(f"jaw={s['jawline']} chk={s['cheekbones']} eye={s['eyes_symmetry']} nose={s['nose_harmony']} sym={s['facial_symmetry']} skin={s['skin_quality']} dim={s['sexual_dimorphism']}")
-
-            # Save progress every 50 images
-            if (i + 1) % 50 == 0:
-                save_progress({"completed": completed, "failed": failed})
-                save_output(completed, failed)
-                elapsed = time.time() - start_time
-                rate = (i + 1) / elapsed * 3600
-                print(f"  [Saved progress: {len(completed)} done, {rate:.0f}/hr]")
-
-            # Rate limiting
-            time.sleep(0.3)
-
-        except Exception as e:
-            print(f"FAILED - {e}")
-            if filename not in failed:
-                failed.append(filename)
-
-    # Final save
-    save_progress({"completed": completed, "failed": failed})
-    save_output(completed, failed)
+        # Final save, also on Ctrl-C or a failed run: every result is already
+        # in the log, so compact it into the progress file
+        progress = store.compact()
+        completed = progress["completed"]
+        failed = progress["failed"]
+        save_output(completed, failed)
 
     # Combine datasets
     combine_datasets()
@@ -413,6 +346,7 @@ def main():
     print("=" * 70)
     print(f"Processed: {len(completed)} images")
     print(f"Failed: {len(failed)} images")
+    print(f"Prompt cache: {labeler.cached_tokens}/{labeler.prompt_tokens} tokens ({labeler.cache_hit_rate():.0%})")
     print(f"Time: {elapsed/3600:.1f} hours")
     print(f"Output: {OUTPUT_FILE}")
     print(f"Combined: {FINAL_COMBINED_FILE}")
@@ -422,4 +356,4 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())
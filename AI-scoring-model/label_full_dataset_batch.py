@@ -0,0 +1,242 @@
+"""
+Label the Images folder through the OpenAI Batch API.
+
+Sends the same requests as label_full_dataset.py (prompts, model, images per
+request) as offline batch jobs: half the price and outside the per-minute
+rate limits, with results within 24 hours. Submitted batch ids are kept in
+a state file, so re-running the script resumes polling instead of
+submitting again. Results land in the same progress and output files.
+"""
+
+import time
+from pathlib import Path
+
+from openai import OpenAI
+
+from label_full_dataset import (
+    OPENAI_API_KEY, IMAGES_DIR, MODEL, TEMPERATURE, IMAGES_PER_REQUEST, ALL_METRICS,
+    SYSTEM_PROMPT, USER_PROMPT, PROGRESS_FILE, OUTPUT_FILE, FINAL_COMBINED_FILE,
+    get_all_images, save_output, combine_datasets,
+)
+from labeler import (
+    ProgressStore, encode_image_to_base64, build_user_content, parse_batch_scores, fully_scored_keys,
+    prompt_cache_user, json_dumps, json_loads, read_json, write_json_atomic,
+)
+
+# ============================================================================
+# Configuration
+# ============================================================================
+
+BATCH_DIR = Path(__file__).parent / "batch_requests"
+BATCH_STATE_FILE = Path(__file__).parent / "labeling_batches.json"
+
+PREFIX_FILTER = "CM"  # Same filter as label_full_dataset.py (set to None for all)
+
+# API limits per input file: 200 MB and 50,000 requests
+MAX_BATCH_FILE_BYTES = 190 * 1024 * 1024
+MAX_BATCH_REQUESTS = 50000
+
+ALL_METRICS_SET = frozenset(ALL_METRICS)
+
+POLL_INTERVAL = 60  # Seconds between status checks
+TERMINAL_STATUSES = {"completed", "failed", "expired", "cancelled"}
+
+
+# ============================================================================
+# Helper Functions
+# ============================================================================
+
+def build_request(custom_id: str, image_paths: list) -> dict:
+    """One Batch API line with the same body score_images sends."""
+    content = build_user_content(USER_PROMPT, [encode_image_to_base64(image_path) for image_path in image_paths])
+    return {
+        "custom_id": custom_id,
+        "method": "POST",
+        "url": "/v1/chat/completions",
+        "body": {
+            "model": MODEL,
+            "temperature": TEMPERATURE,
+            "user": prompt_cache_user(SYSTEM_PROMPT),
+            "response_format": {"type": "json_object"},
+            "messages": [
+                {"role": "system", "content": SYSTEM_PROMPT},
+                {"role": "user", "content": content},
+            ],
+        },
+    }
+
+
+def write_request_files(groups: dict) -> list:
+    """Write JSONL request files, starting a new one before a file would exceed the API limits."""
+    BATCH_DIR.mkdir(exist_ok=True)
+    files = []
+    f = None
+    size = count = 0
+
+    for custom_id, rel_paths in groups.items():
+        line = json_dumps(build_request(custom_id, [IMAGES_DIR / rel_path for rel_path in rel_paths])) + b"\n"
+        if f is None or size + len(line) > MAX_BATCH_FILE_BYTES or count >= MAX_BATCH_REQUESTS:
+            if f is not None:
+                f.close()
+            path = BATCH_DIR / f"requests_{len(files):03d}.jsonl"
+            f = open(path, "wb")
+            files.append(path)
+            size = count = 0
+        f.write(line)
+        size += len(line)
+        count += 1
+
+    if f is not None:
+        f.close()
+    return files
+
+
+def submit_batches(client: OpenAI, state: dict):
+    """Upload each request file not yet submitted and start a batch job for it.
+
+    The state file is rewritten after every batch, so a failure part way
+    through never orphans (and a re-run never pays twice for) created batches.
+    """
+    for name in state["request_files"][len(state["batches"]):]:
+        path = BATCH_DIR / name
+        with open(path, "rb") as f:
+            input_file = client.files.create(file=f, purpose="batch")
+        batch = client.batches.create(
+            input_file_id=input_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h",
+        )
+        print(f"  Submitted {path.name} -> {batch.id}")
+        state["batches"].append(batch.id)
+        write_json_atomic(BATCH_STATE_FILE, state)
+
+
+def wait_for_batches(client: OpenAI, batch_ids: list) -> list:
+    """Poll until every batch reaches a terminal status."""
+    while True:
+        batches = [client.batches.retrieve(batch_id) for batch_id in batch_ids]
+        for batch in batches:
+            counts = batch.request_counts
+            done = f"{counts.completed + counts.failed}/{counts.total}" if counts else "?"
+            print(f"  {batch.id}: {batch.status} ({done})")
+
+        if all(batch.status in TERMINAL_STATUSES for batch in batches):
+            return batches
+        time.sleep(POLL_INTERVAL)
+
+
+def read_file_lines(client: OpenAI, file_id: str) -> list:
+    """Download a batch output/error file as parsed JSONL records."""
+    if not file_id:
+        return []
+    content = client.files.content(file_id).content
+    return [json_loads(line) for line in content.splitlines() if line.strip()]
+
+
+def collect_results(client: OpenAI, batches: list, groups: dict, completed: dict, failed: list):
+    """Parse batch outputs into completed; every image without scores is marked failed."""
+    scored = set()
+
+    for batch in batches:
+        records = read_file_lines(client, batch.output_file_id) + read_file_lines(client, batch.error_file_id)
+        for record in records:
+            rel_paths = groups.get(record["custom_id"])
+            if rel_paths is None:
+                continue
+            response = record.get("response") or {}
+            if record.get("error") or response.get("status_code") != 200:
+                print(f"  {record['custom_id']}: FAILED - {record.get('error') or response.get('status_code')}")
+                continue
+            try:
+                raw = response["body"]["choices"][0]["message"]["content"]
+                scores = parse_batch_scores(raw, len(rel_paths), ALL_METRICS, ALL_METRICS_SET)
+            except (KeyError, IndexError, ValueError) as e:
+                print(f"  {record['custom_id']}: FAILED - {e}")
+                continue
+            for index, rel_path in enumerate(rel_paths, start=1):
+                completed[rel_path] = scores[index]
+                scored.add(rel_path)
+
+    for rel_paths in groups.values():
+        for rel_path in rel_paths:
+            if rel_path not in scored and rel_path not in failed:
+                failed.append(rel_path)
+
+
+# ============================================================================
+# Main
+# ============================================================================
+
+def main():
+    print("=" * 70)
+    print("Full Dataset Labeling - 7 Metrics (Batch API)")
+    print("=" * 70)
+
+    client = OpenAI(api_key=OPENAI_API_KEY)
+
+    store = ProgressStore(PROGRESS_FILE)
+    progress = store.load()
+    completed = progress["completed"]
+    failed = progress["failed"]
+
+    if BATCH_STATE_FILE.exists():
+        # Resume batches submitted by an earlier run, submitting any it didn't get to
+        state = read_json(BATCH_STATE_FILE)
+        print(f"\nResuming {len(state['batches'])}/{len(state['request_files'])} submitted batches")
+        submit_batches(client, state)
+    else:
+        print(f"\nScanning: {IMAGES_DIR}")
+        all_images = get_all_images(IMAGES_DIR, prefix_filter=PREFIX_FILTER)
+        # Same skip rule as label_full_dataset.py: progress plus fully scored output entries
+        done = completed.keys() | fully_scored_keys(OUTPUT_FILE, ALL_METRICS)
+        remaining = [
+            rel_path for img in all_images
+            if (rel_path := img.relative_to(IMAGES_DIR).as_posix()) not in done
+        ]
+        print(f"Found {len(all_images)} images, {len(remaining)} remaining")
+
+        if not remaining:
+            print("\nAll images already processed!")
+            combine_datasets()
+            return
+
+        groups = {
+            f"group-{i // IMAGES_PER_REQUEST:06d}": remaining[i:i + IMAGES_PER_REQUEST]
+            for i in range(0, len(remaining), IMAGES_PER_REQUEST)
+        }
+        print(f"Writing {len(groups)} requests ({IMAGES_PER_REQUEST} images each)...")
+        request_files = write_request_files(groups)
+
+        print(f"Submitting {len(request_files)} batch files...")
+        state = {"groups": groups, "request_files": [path.name for path in request_files], "batches": []}
+        write_json_atomic(BATCH_STATE_FILE, state)
+        submit_batches(client, state)
+
+    print("-" * 70)
+    batches = wait_for_batches(client, state["batches"])
+
+    print("\nCollecting results...")
+    try:
+        collect_results(client, batches, state["groups"], completed, failed)
+    finally:
+        # Keep whatever was parsed; the state file stays until collection succeeds
+        store.save(progress)
+        save_output(completed, failed)
+    combine_datasets()
+
+    # Results are merged into the progress file; the next run starts fresh
+    for name in state["request_files"]:
+        (BATCH_DIR / name).unlink(missing_ok=True)
+    BATCH_STATE_FILE.unlink()
+
+    print("\n" + "=" * 70)
+    print("COMPLETE")
+    print("=" * 70)
+    print(f"Processed: {len(completed)} images")
+    print(f"Failed: {len(failed)} images")
+    print(f"Output: {OUTPUT_FILE}")
+    print(f"Combined: {FINAL_COMBINED_FILE}")
+
+
+if __name__ == "__main__":
+    main()
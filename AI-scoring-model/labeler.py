@@ -0,0 +1,531 @@
+"""
+Shared GPT-4o Vision labeling machinery.
+
+Used by label_full_dataset.py, generate_missing_scores.py and
+label_full_dataset_batch.py: the HTTP/2 OpenAI client, rate limiting, image
+encoding, response parsing, the append-only progress store and the async
+request loop. Each script supplies its own prompts, metrics and file paths.
+"""
+
+import json
+import base64
+import hashlib
+import io
+import math
+import mmap
+import os
+import re
+import time
+import asyncio
+from collections import deque
+from pathlib import Path
+import httpx
+from PIL import Image
+import openai
+from openai import AsyncOpenAI
+
+try:
+    import orjson  # Faster encode/decode for progress and output files
+except ImportError:
+    orjson = None
+
+try:
+    import ijson  # Streams completed keys out of the progress file on startup
+except ImportError:
+    ijson = None
+
+# ============================================================================
+# Configuration
+# ============================================================================
+
+# Connection config
+HTTP_POOL_SIZE = 64  # Kept-alive connections shared by all requests
+REQUEST_TIMEOUT = 60.0
+
+COMPLETION_TOKEN_ESTIMATE = 100  # Per image, for the rate limiter's token budget
+RATE_WINDOW = 100  # Recent completions used for the reported rate and ETA
+
+# Upload config: scoring needs facial structure, not full resolution
+DOWNSCALE = True  # Re-encode uploads as JPEG no larger than MAX_UPLOAD_SIZE
+MAX_UPLOAD_SIZE = 1024
+UPLOAD_JPEG_QUALITY = 85
+IMAGE_DETAIL = "high"  # "low" bills a flat 85 tokens per image but sees only 512px
+
+# Outermost {...} in a response wrapped in code fences or text
+JSON_OBJECT_PATTERN = re.compile(r"\{.*\}", re.S)
+
+
+# ============================================================================
+# JSON Helpers
+# ============================================================================
+
+def json_loads(data):
+    """Decode JSON text or bytes, with orjson when installed."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def json_dumps(data, pretty: bool = False) -> bytes:
+    """Encode JSON to bytes, with orjson when installed."""
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_INDENT_2 if pretty else 0, default=str)
+    return json.dumps(data, indent=2 if pretty else None, default=str).encode()
+
+
+def read_json(path: Path):
+    """Load a JSON file."""
+    with open(path, "rb") as f:
+        return json_loads(f.read())
+
+
+def write_json_atomic(path: Path, data, pretty: bool = False):
+    """Write to a temp file and rename it over `path`, so readers never see a partial file."""
+    tmp_path = path.with_name(path.name + ".tmp")
+    with open(tmp_path, "wb") as f:
+        f.write(json_dumps(data, pretty))
+    os.replace(tmp_path, path)
+
+
+# ============================================================================
+# Requests
+# ============================================================================
+
+def create_client(api_key: str) -> AsyncOpenAI:
+    """OpenAI client on a shared HTTP/2 connection pool.
+
+    HTTP/2 multiplexes the in-flight requests over a few kept-alive TLS
+    connections. SDK retries are off so 429s reach the shared limiter.
+    """
+    http_client = httpx.AsyncClient(
+        http2=True,
+        limits=httpx.Limits(max_connections=HTTP_POOL_SIZE, max_keepalive_connections=HTTP_POOL_SIZE),
+        timeout=httpx.Timeout(REQUEST_TIMEOUT),
+    )
+    return AsyncOpenAI(api_key=api_key, max_retries=0, http_client=http_client)
+
+
+def prompt_cache_user(system_prompt: str) -> str:
+    """Stable end-user id so every request routes to the same cached prompt prefix."""
+    return hashlib.sha256(system_prompt.encode()).hexdigest()[:16]
+
+
+class RateLimiter:
+    """Proactive requests/min + tokens/min throttle (two token buckets).
+
+    Callers block only while a bucket is empty, so throughput tracks the
+    account limits instead of a fixed sleep. A 429 pauses all callers.
+    """
+
+    def __init__(self, max_requests_per_minute: int, max_tokens_per_minute: int):
+        self.max_requests = max_requests_per_minute
+        self.max_tokens = max_tokens_per_minute
+        self.available_requests = float(max_requests_per_minute)
+        self.available_tokens = float(max_tokens_per_minute)
+        self.last_refill = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = asyncio.Lock()
+        self.granted = deque()  # (monotonic time, tokens) over the last minute
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self.last_refill
+        self.last_refill = now
+        self.available_requests = min(self.max_requests, self.available_requests + elapsed * self.max_requests / 60)
+        self.available_tokens = min(self.max_tokens, self.available_tokens + elapsed * self.max_tokens / 60)
+
+    async def acquire(self, tokens: int):
+        """Wait until one request and `tokens` tokens are available."""
+        tokens = min(tokens, self.max_tokens)
+        # Holding the lock while waiting serves callers in FIFO order
+        async with self.lock:
+            while True:
+                pause = self.paused_until - time.monotonic()
+                if pause > 0:
+                    await asyncio.sleep(pause)
+                    continue
+
+                self._refill()
+                if self.available_requests >= 1 and self.available_tokens >= tokens:
+                    self.available_requests -= 1
+                    self.available_tokens -= tokens
+                    self.granted.append((time.monotonic(), tokens))
+                    return
+
+                # Sleep just long enough for the emptier bucket to refill
+                await asyncio.sleep(max(
+                    (1 - self.available_requests) * 60 / self.max_requests,
+                    (tokens - self.available_tokens) * 60 / self.max_tokens,
+                ))
+
+    def pause(self, seconds: float):
+        """Stop handing out capacity for `seconds` (e.g. from Retry-After)."""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def utilization(self) -> float:
+        """Share of the per-minute limit used over the last minute (the busier of the two buckets)."""
+        cutoff = time.monotonic() - 60
+        while self.granted and self.granted[0][0] < cutoff:
+            self.granted.popleft()
+        tokens = sum(granted_tokens for _, granted_tokens in self.granted)
+        return max(len(self.granted) / self.max_requests, tokens / self.max_tokens)
+
+
+def retry_after_seconds(error: openai.RateLimitError, default: float) -> float:
+    """Read the Retry-After header from a 429, falling back to `default`."""
+    try:
+        return float(error.response.headers.get("retry-after", default))
+    except (TypeError, ValueError):
+        return default
+
+
+# ============================================================================
+# Images
+# ============================================================================
+
+def estimate_image_tokens(image_path: Path) -> int:
+    """GPT-4o vision cost: 85 base + 170 per 512px tile (high detail only)."""
+    if IMAGE_DETAIL == "low":
+        return 85
+    with Image.open(image_path) as img:
+        width, height = img.size
+    if DOWNSCALE:
+        scale = min(1.0, MAX_UPLOAD_SIZE / max(width, height))
+        width, height = width * scale, height * scale
+    # The API fits the image in 2048x2048, then scales the short side to 768
+    scale = min(1.0, 2048 / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, 768 / min(width, height))
+    width, height = width * scale, height * scale
+    return 85 + 170 * math.ceil(width / 512) * math.ceil(height / 512)
+
+
+def encode_image_to_base64(image_path: Path) -> str:
+    """Read image and encode to base64 data URL.
+
+    Each image is encoded once per request; retries resend the same content.
+    """
+    if DOWNSCALE:
+        # Fewer bytes to upload and fewer 512px tiles billed
+        with Image.open(image_path) as img:
+            img = img.convert("RGB")
+        img.thumbnail((MAX_UPLOAD_SIZE, MAX_UPLOAD_SIZE), Image.LANCZOS)
+        buffer = io.BytesIO()
+        img.save(buffer, "JPEG", quality=UPLOAD_JPEG_QUALITY, optimize=True)
+        b64 = base64.b64encode(buffer.getbuffer()).decode("ascii")
+        return f"data:image/jpeg;base64,{b64}"
+
+    # Encode straight from the mapped file instead of copying it into a bytes object
+    with open(image_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        with memoryview(mapped) as view:
+            b64 = base64.b64encode(view).decode("ascii")
+
+    suffix = Path(image_path).suffix.lower()
+    mime_map = {".jpg": "image/jpeg", ".jpeg": "image/jpeg", ".png": "image/png"}
+    mime = mime_map.get(suffix, "image/jpeg")
+
+    return f"data:{mime};base64,{b64}"
+
+
+def build_user_content(user_prompt: str, data_urls: list) -> list:
+    """User message for a batch: the prompt, then each image behind a numbered label."""
+    content = [{"type": "text", "text": user_prompt}]
+    for index, data_url in enumerate(data_urls, start=1):
+        content.append({"type": "text", "text": f"Image {index}:"})
+        content.append({"type": "image_url", "image_url": {"url": data_url, "detail": IMAGE_DETAIL}})
+    return content
+
+
+# ============================================================================
+# Response Parsing
+# ============================================================================
+
+def parse_json_object(raw_response: str) -> dict:
+    """Parse the JSON object in a model response.
+
+    json_object mode returns bare JSON, so that is tried first; the search
+    past code fences or surrounding text only runs if it fails.
+    """
+    try:
+        return json_loads(raw_response)
+    except json.JSONDecodeError:
+        pass
+
+    match = JSON_OBJECT_PATTERN.search(raw_response)
+    if match is None:
+        raise ValueError(f"Could not parse JSON: {raw_response[:200]}")
+    return json_loads(match.group())
+
+
+def validate_scores(data: dict, metrics: list, metrics_set: frozenset) -> dict:
+    """Check and clamp the metric values for one image (metrics_set is frozenset(metrics), built once by the caller)."""
+    missing = metrics_set - data.keys()
+    if missing:
+        raise ValueError(f"Missing keys {sorted(missing)}")
+    for key in metrics:
+        if not isinstance(data[key], (int, float)):
+            raise ValueError(f"Invalid value for '{key}': {data[key]}")
+
+    # Clamp to 0-100 and round
+    return {key: max(0, min(100, round(data[key]))) for key in metrics}
+
+
+def parse_batch_scores(raw_response: str, count: int, metrics: list, metrics_set: frozenset) -> dict:
+    """Parse a batched response mapping image number ("1".."count") to its scores."""
+    data = parse_json_object(raw_response)
+
+    results = {}
+    for index in range(1, count + 1):
+        entry = data.get(str(index))
+        if not isinstance(entry, dict):
+            raise ValueError(f"Missing scores for image {index}")
+        results[index] = validate_scores(entry, metrics, metrics_set)
+
+    return results
+
+
+# ============================================================================
+# Progress
+# ============================================================================
+
+class ProgressStore:
+    """Progress file plus a JSONL log that results are appended to as they arrive.
+
+    The log is compacted into the progress file at the end of a run; an
+    interrupted run is resumed by replaying it.
+    """
+
+    def __init__(self, progress_file: Path):
+        self.progress_file = progress_file
+        self.log_file = progress_file.with_suffix(".jsonl")
+        self.log = None
+
+    def __enter__(self):
+        self.log = open(self.log_file, "ab")
+        return self
+
+    def __exit__(self, *exc_info):
+        self.log.close()
+        self.log = None
+
+    def read_log(self):
+        """Yield the records appended since the last compaction."""
+        if not self.log_file.exists():
+            return
+        with open(self.log_file, "rb") as f:
+            for line in f:
+                try:
+                    yield json_loads(line)
+                except json.JSONDecodeError:
+                    continue  # Torn last line from an interrupted run
+
+    def load(self) -> dict:
+        """Load progress, replaying the log."""
+        progress = {"completed": {}, "failed": []}
+        if self.progress_file.exists():
+            progress = read_json(self.progress_file)
+        failed = progress.setdefault("failed", [])
+
+        for record in self.read_log():
+            if "scores" in record:
+                progress["completed"][record["file"]] = record["scores"]
+            elif record["file"] not in failed:
+                failed.append(record["file"])
+        return progress
+
+    def completed_keys(self) -> set:
+        """Keys of completed images, streamed with ijson so the scores are never held in memory."""
+        keys = set()
+        if self.progress_file.exists():
+            if ijson is not None:
+                with open(self.progress_file, "rb") as f:
+                    keys.update(key for key, _ in ijson.kvitems(f, "completed"))
+            else:
+                keys.update(read_json(self.progress_file)["completed"])
+
+        keys.update(record["file"] for record in self.read_log() if "scores" in record)
+        return keys
+
+    def append(self, key: str, scores: dict = None):
+        """Append one result to the log; scores=None records a failure."""
+        record = {"file": key, "scores": scores} if scores is not None else {"file": key, "failed": True}
+        self.log.write(json_dumps(record) + b"\n")
+        self.log.flush()
+
+    def save(self, progress: dict):
+        """Write progress to the progress file and drop the log it now contains."""
+        write_json_atomic(self.progress_file, progress)
+        self.log_file.unlink(missing_ok=True)
+
+    def compact(self) -> dict:
+        """Fold the log into the progress file and return the merged progress."""
+        progress = self.load()
+        self.save(progress)
+        return progress
+
+
+def fully_scored_keys(scores_file: Path, metrics: list) -> set:
+    """Keys in a scores output file ({"scores": {key: {...}}}) that already have every metric."""
+    if not scores_file.exists():
+        return set()
+    required = frozenset(metrics)
+    if ijson is not None:
+        with open(scores_file, "rb") as f:
+            return {key for key, scores in ijson.kvitems(f, "scores") if required.issubset(scores)}
+    return {key for key, scores in read_json(scores_file)["scores"].items() if required.issubset(scores)}
+
+
+# ============================================================================
+# Labeler
+# ============================================================================
+
+class AsyncLabeler:
+    """Scores images in groups of `images_per_request` with bounded concurrency.
+
+    Every result is appended to the progress store as it arrives, so a run
+    can be interrupted at any point and resumed.
+    """
+
+    def __init__(
+        self,
+        client: AsyncOpenAI,
+        limiter: RateLimiter,
+        store: ProgressStore,
+        metrics: list,
+        system_prompt: str,
+        user_prompt: str,
+        model: str = "gpt-4o",
+        temperature: float = 0.1,
+        images_per_request: int = 5,
+        max_concurrent_requests: int = 16,
+        report_every: int = 50,
+        describe=None,
+    ):
+        self.client = client
+        self.limiter = limiter
+        self.store = store
+        self.metrics = metrics
+        self.metrics_set = frozenset(metrics)
+        self.system_prompt = system_prompt
+        self.user_prompt = user_prompt
+        self.model = model
+        self.temperature = temperature
+        self.images_per_request = images_per_request
+        self.max_concurrent_requests = max_concurrent_requests
+        self.report_every = report_every
+        self.describe = describe or (lambda scores: "OK")
+        self.cache_user = prompt_cache_user(system_prompt)
+        self.prompt_tokens = 0
+        self.cached_tokens = 0
+
+    def estimate_request_tokens(self, image_paths: list) -> int:
+        """Rough prompt + completion token count for one batched scoring request."""
+        prompt_tokens = (len(self.system_prompt) + len(self.user_prompt)) // 4
+        image_tokens = sum(estimate_image_tokens(image_path) for image_path in image_paths)
+        return prompt_tokens + image_tokens + COMPLETION_TOKEN_ESTIMATE * len(image_paths)
+
+    def prepare_request(self, image_paths: list) -> tuple:
+        """Encoded message content and token estimate for one request (blocking PIL work)."""
+        content = build_user_content(self.user_prompt, [encode_image_to_base64(image_path) for image_path in image_paths])
+        return content, self.estimate_request_tokens(image_paths)
+
+    def record_usage(self, usage):
+        """Accumulate prompt tokens and the share served from OpenAI's prompt cache."""
+        if usage is None:
+            return
+        self.prompt_tokens += usage.prompt_tokens
+        details = usage.prompt_tokens_details
+        if details is not None and details.cached_tokens:
+            self.cached_tokens += details.cached_tokens
+
+    def cache_hit_rate(self) -> float:
+        """Fraction of prompt tokens so far that were cache hits."""
+        if not self.prompt_tokens:
+            return 0.0
+        return self.cached_tokens / self.prompt_tokens
+
+    async def score_images(self, image_paths: list, max_retries: int = 3) -> list:
+        """Score a batch of images in one request, returning scores in input order."""
+        # Decode/resize/encode off the event loop so in-flight requests keep moving
+        content, token_estimate = await asyncio.to_thread(self.prepare_request, image_paths)
+        label = f"{image_paths[0].name} (+{len(image_paths) - 1})"
+
+        for attempt in range(max_retries):
+            await self.limiter.acquire(token_estimate)
+            try:
+                response = await self.client.chat.completions.create(
+                    model=self.model,
+                    temperature=self.temperature,
+                    user=self.cache_user,
+                    response_format={"type": "json_object"},
+                    messages=[
+                        {"role": "system", "content": self.system_prompt},
+                        {"role": "user", "content": content},
+                    ],
+                )
+
+                self.record_usage(response.usage)
+                raw = response.choices[0].message.content
+                scores = parse_batch_scores(raw, len(image_paths), self.metrics, self.metrics_set)
+                return [scores[index] for index in range(1, len(image_paths) + 1)]
+
+            except openai.RateLimitError as e:
+                # Pause the shared limiter instead of sleeping only this task
+                print(f"  {label}: rate limited (attempt {attempt + 1})")
+                if attempt < max_retries - 1:
+                    self.limiter.pause(retry_after_seconds(e, 2 ** attempt))
+                else:
+                    raise
+
+            except Exception as e:
+                print(f"  {label}: attempt {attempt + 1} failed: {e}")
+                if attempt < max_retries - 1:
+                    await asyncio.sleep(2 ** attempt)
+                else:
+                    raise
+
+    async def run(self, items: list):
+        """Score (key, image_path) pairs, appending each result to the progress store."""
+        self.total = len(items)
+        self.done = 0
+        self.last_report = 0
+        self.recent = deque(maxlen=RATE_WINDOW)  # Completion times for the rolling rate
+        self.semaphore = asyncio.Semaphore(self.max_concurrent_requests)
+
+        step = self.images_per_request
+        with self.store:
+            async with asyncio.TaskGroup() as group:
+                for i in range(0, len(items), step):
+                    group.create_task(self._score_group(items[i:i + step]))
+
+    async def _score_group(self, items: list):
+        keys = [key for key, _ in items]
+        async with self.semaphore:
+            try:
+                group_scores = await self.score_images([image_path for _, image_path in items])
+            except Exception as e:
+                # A bad response fails the whole group; the images are retried on the next run
+                for key in keys:
+                    self.done += 1
+                    self.recent.append(time.monotonic())
+                    print(f"[{self.done}/{self.total}] {key} ... FAILED - {e}")
+                    self.store.append(key)
+                return
+
+        # Tasks share one event loop thread, so the counters and log need no locking
+        for key, scores in zip(keys, group_scores):
+            self.done += 1
+            self.recent.append(time.monotonic())
+            self.store.append(key, scores)
+            print(f"[{self.done}/{self.total}] {key} ... {self.describe(scores)}")
+
+        # Report progress periodically, with the rate over recent completions only
+        if self.done - self.last_report >= self.report_every and len(self.recent) >= 2:
+            self.last_report = self.done
+            window = self.recent[-1] - self.recent[0]
+            per_second = (len(self.recent) - 1) / window if window > 0 else 0.0
+            eta = f"{(self.total - self.done) / per_second / 60:.0f} min" if per_second else "?"
+            print(
+                f"  [Progress: {self.done}/{self.total} done, {per_second * 3600:.0f}/hr, ETA {eta}, "
+                f"{self.limiter.utilization():.0%} of rate limit, {self.cache_hit_rate():.0%} prompt cached]"
+            )
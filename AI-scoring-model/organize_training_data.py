@@ -3,10 +3,15 @@ Organize all scored images into a clean training_data folder.
 Copies images and creates a unified scores file for ML training.
 """
 
+import os
+import csv
 import json
 import shutil
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
+from labeler import ProgressStore
+
 # Paths
 BASE_DIR = Path(__file__).parent
 TRAINING_DIR = BASE_DIR / "training_data"
@@ -25,6 +30,9 @@ IMAGES_DIR = BASE_DIR / "Images"
 FINAL_SCORES_FILE = TRAINING_DIR / "scores.json"
 FINAL_CSV_FILE = TRAINING_DIR / "scores.csv"
 
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+COPY_WORKERS = 16  # Copies are I/O-bound, threads overlap them
+
 ALL_METRICS = [
     "jawline",
     "cheekbones",
@@ -34,6 +42,33 @@ ALL_METRICS = [
     "skin_quality",
     "sexual_dimorphism",
 ]
+METRICS_SET = frozenset(ALL_METRICS)
+
+
+def index_images(root: Path) -> dict:
+    """Map lowercase filename -> path for every image under root, in one scandir walk."""
+    index = {}
+    stack = [root]
+    while stack:
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.name.lower().endswith(IMAGE_EXTENSIONS):
+                    index.setdefault(entry.name.lower(), Path(entry.path))
+    return index
+
+
+def copy_image(src: Path, dest: Path) -> bool:
+    """Hardlink src to dest, falling back to a copy. Returns False if dest already exists."""
+    try:
+        os.link(src, dest)
+    except FileExistsError:
+        return False
+    except OSError:
+        # Different filesystem or no hardlink support
+        shutil.copy2(src, dest)
+    return True
 
 
 def main():
@@ -46,7 +81,6 @@ def main():
     IMAGES_SUBDIR.mkdir(exist_ok=True)
 
     all_scores = {}
-    copied = 0
     skipped = 0
 
     # 1. Load original 429 scores
@@ -56,39 +90,38 @@ def main():
             data = json.load(f)
         for filename, scores in data.get("scores", {}).items():
             # Check if has all 7 metrics
-            if all(m in scores for m in ALL_METRICS):
+            if METRICS_SET.issubset(scores):
                 all_scores[filename] = scores
         print(f"   Loaded {len(all_scores)} from complete_scores.json")
 
     # 2. Load new scores (from progress file for most up-to-date)
     print("\n2. Loading new image scores...")
     new_count = 0
-    if PROGRESS_FILE.exists():
-        with open(PROGRESS_FILE, "r") as f:
-            progress = json.load(f)
-        for rel_path, scores in progress.get("completed", {}).items():
-            if all(m in scores for m in ALL_METRICS):
-                # Use just filename as key (strip folder path)
-                filename = Path(rel_path).name
-                all_scores[f"new_{filename}"] = scores
-                new_count += 1
+    # Replays the .jsonl log too, so results from an interrupted labeling run are included
+    progress = ProgressStore(PROGRESS_FILE).load()
+    for rel_path, scores in progress.get("completed", {}).items():
+        if METRICS_SET.issubset(scores):
+            # Use just filename as key (strip folder path)
+            filename = Path(rel_path).name
+            all_scores[f"new_{filename}"] = scores
+            new_count += 1
     print(f"   Loaded {new_count} from new images")
 
     print(f"\n   TOTAL: {len(all_scores)} images with complete scores")
 
     # 3. Copy images to training folder
     print("\n3. Copying images to training_data/images/...")
+    images_index = index_images(IMAGES_DIR) if IMAGES_DIR.exists() else {}
+    copy_sources, copy_dests = [], []
 
     for key, scores in all_scores.items():
         # Determine source path
         if key.startswith("new_"):
             # New image - find in Images folder
             original_name = key[4:]  # Remove "new_" prefix
-            # Search for file
-            matches = list(IMAGES_DIR.rglob(original_name))
-            if matches:
-                src = matches[0]
-            else:
+            # Look up file in the Images folder index
+            src = images_index.get(original_name.lower())
+            if src is None:
                 print(f"   WARNING: Could not find {original_name}")
                 skipped += 1
                 continue
@@ -101,15 +134,17 @@ def main():
         dest = IMAGES_SUBDIR / dest_name
 
         if src.exists():
-            if not dest.exists():
-                shutil.copy2(src, dest)
-                copied += 1
+            copy_sources.append(src)
+            copy_dests.append(dest)
             # Update key to match destination filename
             all_scores[key] = scores
         else:
             print(f"   WARNING: Source not found: {src}")
             skipped += 1
 
+    with ThreadPoolExecutor(max_workers=COPY_WORKERS) as pool:
+        copied = sum(pool.map(copy_image, copy_sources, copy_dests))
+
     print(f"   Copied: {copied} images")
     print(f"   Skipped: {skipped} images")
 
@@ -148,12 +183,10 @@ def main():
     print(f"   Saved: {FINAL_SCORES_FILE}")
 
     # CSV format (easier for some ML frameworks)
-    with open(FINAL_CSV_FILE, "w") as f:
-        header = ["image"] + ALL_METRICS
-        f.write(",".join(header) + "\n")
-        for record in data_list:
-            row = [record["image"]] + [str(record[m]) for m in ALL_METRICS]
-            f.write(",".join(row) + "\n")
+    with open(FINAL_CSV_FILE, "w", newline="", buffering=1 << 20) as f:
+        writer = csv.writer(f)
+        writer.writerow(["image", *ALL_METRICS])
+        writer.writerows([record["image"], *(record[m] for m in ALL_METRICS)] for record in data_list)
     print(f"   Saved: {FINAL_CSV_FILE}")
 
     # Summary
@@ -0,0 +1,76 @@
+"""
+Post-training static INT8 quantization of the facial scoring model for CPU.
+Calibrates on a sample of dataset images and saves best_model_int8.pth,
+which the API loads instead of the FP32 checkpoint when running on CPU.
+"""
+
+import random
+from pathlib import Path
+
+import torch
+from torch.ao.quantization import get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+from test_model import FacialScoreModel, get_inference_transform, load_image, MODEL_PATH, IMAGE_SIZE
+
+# ============================================================================
+# Configuration
+# ============================================================================
+
+BASE_DIR = Path(__file__).parent
+CALIBRATION_DIR = BASE_DIR / "normalized_dataset"
+INT8_MODEL_PATH = MODEL_PATH.with_name("best_model_int8.pth")
+
+NUM_CALIBRATION_IMAGES = 100
+QUANTIZED_ENGINE = "x86"  # oneDNN/FBGEMM, uses VNNI int8 dot products where available
+SEED = 42
+
+
+def prepare_for_quantization(float_model):
+    """Insert calibration observers (graph must match api/main.py)."""
+    example_inputs = (torch.zeros(1, 3, IMAGE_SIZE, IMAGE_SIZE),)
+    return prepare_fx(float_model, get_default_qconfig_mapping(QUANTIZED_ENGINE), example_inputs)
+
+
+def main():
+    print("=" * 60)
+    print("INT8 Model Quantization")
+    print("=" * 60)
+
+    torch.backends.quantized.engine = QUANTIZED_ENGINE
+
+    # Load FP32 model
+    print(f"\nLoading model from: {MODEL_PATH}")
+    model = FacialScoreModel(pretrained=False)
+    checkpoint = torch.load(MODEL_PATH, map_location="cpu", weights_only=False)
+    model.load_state_dict(checkpoint["model_state_dict"])
+    model.eval()
+
+    # Sample calibration images
+    image_files = [f for f in CALIBRATION_DIR.iterdir() if f.suffix.lower() in [".jpg", ".jpeg", ".png"]]
+    random.seed(SEED)
+    calibration_files = random.sample(image_files, min(NUM_CALIBRATION_IMAGES, len(image_files)))
+    print(f"Calibrating on {len(calibration_files)} images from: {CALIBRATION_DIR}")
+
+    # Calibrate observers
+    prepared = prepare_for_quantization(model)
+    transform = get_inference_transform()
+    with torch.no_grad():  # Observers update their buffers in place
+        for image_path in calibration_files:
+            prepared(transform(load_image(image_path)).unsqueeze(0))
+
+    quantized = convert_fx(prepared)
+
+    torch.save({
+        "epoch": checkpoint["epoch"],
+        "model_state_dict": quantized.state_dict(),
+        "quantized_engine": QUANTIZED_ENGINE,
+        "calibration_images": len(calibration_files),
+    }, INT8_MODEL_PATH)
+
+    print(f"\nSaved INT8 model: {INT8_MODEL_PATH}")
+    print(f"Size: {INT8_MODEL_PATH.stat().st_size / 1e6:.1f} MB")
+
+
+if __name__ == "__main__":
+    main()
@@ -9,5 +9,14 @@ echo "PORT env: $PORT"
 PORT="${PORT:-8000}"
 echo "Using PORT: $PORT"
 
-# Start uvicorn
-exec uvicorn api.main:app --host 0.0.0.0 --port "$PORT"
+# Single worker by default. Each extra worker loads its own full model copy
+# (memory grows linearly, and nproc in a container can report the host's
+# cores), and splits traffic so each process's micro-batcher and score cache
+# see less of it. Raise WEB_CONCURRENCY on CPU hosts with memory to spare.
+WEB_CONCURRENCY="${WEB_CONCURRENCY:-1}"
+export WEB_CONCURRENCY
+echo "Using workers: $WEB_CONCURRENCY"
+
+# Start uvicorn (uvloop + httptools ship with uvicorn[standard])
+exec uvicorn api.main:app --host 0.0.0.0 --port "$PORT" \
+    --workers "$WEB_CONCURRENCY" --loop uvloop --http httptools
@@ -6,13 +6,23 @@ Tests the model on validation images and compares predictions with ground truth.
 import os
 import json
 import random
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 from pathlib import Path
-from PIL import Image
+import numpy as np
 import torch
 import torch.nn as nn
 from torchvision import transforms
+from torchvision.io import read_image, ImageReadMode
 import timm
 
+from dataset_index import get_scored_image_paths
+
+try:
+    import onnxruntime as ort
+except ImportError:
+    ort = None
+
 # ============================================================================
 # Configuration (must match train_model.py)
 # ============================================================================
@@ -22,6 +32,10 @@ TRAINING_DIR = BASE_DIR / "training_data"
 IMAGES_DIR = TRAINING_DIR / "images"
 SCORES_FILE = TRAINING_DIR / "scores.json"
 MODEL_PATH = BASE_DIR / "model_output" / "best_model.pth"
+ONNX_PATH = MODEL_PATH.with_name("facial_scorer.onnx")  # Used instead of the .pth when present
+
+# ONNX Runtime providers in order of preference (unavailable ones are skipped)
+ONNX_PROVIDERS = ["CUDAExecutionProvider", "CPUExecutionProvider"]
 
 MODEL_NAME = "efficientnet_b0"
 IMAGE_SIZE = 224
@@ -36,6 +50,9 @@ METRICS = [
     "sexual_dimorphism",
 ]
 
+# Input shape is fixed, so let cuDNN pick the fastest conv algorithms once
+torch.backends.cudnn.benchmark = True
+
 # ============================================================================
 # Model (same as train_model.py)
 # ============================================================================
@@ -72,15 +89,27 @@ class FacialScoreModel(nn.Module):
 # ============================================================================
 
 def get_inference_transform():
-    """Get inference transforms (no augmentation)."""
-    return transforms.Compose([
-        transforms.Resize((IMAGE_SIZE, IMAGE_SIZE)),
-        transforms.ToTensor(),
+    """Get inference transforms (no augmentation) for uint8 (3, H, W) tensors on any device."""
+    return nn.Sequential(
+        transforms.ConvertImageDtype(torch.float32),
+        transforms.Resize((IMAGE_SIZE, IMAGE_SIZE), antialias=True),
         transforms.Normalize(
             mean=[0.485, 0.456, 0.406],
             std=[0.229, 0.224, 0.225]
         ),
-    ])
+    )
+
+
+def load_image(image_path):
+    """Decode an image file to a uint8 (3, H, W) RGB tensor."""
+    return read_image(str(image_path), mode=ImageReadMode.RGB)
+
+
+def get_autocast_dtype(device):
+    """Mixed-precision dtype for the forward pass: BF16 where supported, else FP16."""
+    if device.type == "cuda" and torch.cuda.is_bf16_supported():
+        return torch.bfloat16
+    return torch.float16
 
 
 def load_model(model_path, device):
@@ -90,9 +119,13 @@ def load_model(model_path, device):
     model = FacialScoreModel(pretrained=False)
     checkpoint = torch.load(model_path, map_location=device, weights_only=False)
     model.load_state_dict(checkpoint["model_state_dict"])
-    model = model.to(device)
+    model = model.to(device, memory_format=torch.channels_last)  # NHWC for Tensor Core convs
     model.eval()
 
+    # Inductor fuses conv+BN+activation chains; CUDA graphs cut launch overhead
+    if hasattr(torch, "compile") and device.type == "cuda":
+        model = torch.compile(model, mode="reduce-overhead")
+
     print(f"Model loaded from epoch {checkpoint['epoch'] + 1}")
     print(f"Validation MAE from training:")
     for i, metric in enumerate(METRICS):
@@ -101,17 +134,82 @@ def load_model(model_path, device):
     return model
 
 
-def predict_single_image(model, image_path, transform, device):
-    """Predict scores for a single image."""
-    image = Image.open(image_path).convert("RGB")
-    image_tensor = transform(image).unsqueeze(0).to(device)
+def load_onnx_session(onnx_path):
+    """Load the exported ONNX model into an ONNX Runtime session."""
+    print(f"Loading ONNX model from: {onnx_path}")
+
+    available = set(ort.get_available_providers())
+    providers = [p for p in ONNX_PROVIDERS if p in available]
+    session = ort.InferenceSession(str(onnx_path), providers=providers)
+
+    print(f"ONNX Runtime providers: {session.get_providers()}")
+    return session
+
+
+def load_predictor(device):
+    """ONNX Runtime session if the exported model is usable, else the PyTorch model."""
+    if ort is None:
+        print("Backend: PyTorch (onnxruntime not installed)")
+    elif not ONNX_PATH.exists():
+        print(f"Backend: PyTorch ({ONNX_PATH.name} not found)")
+    elif ONNX_PATH.stat().st_mtime < MODEL_PATH.stat().st_mtime:
+        # train_model.py keeps the old export when re-exporting fails
+        print(f"Backend: PyTorch ({ONNX_PATH.name} is older than {MODEL_PATH.name})")
+    else:
+        print("Backend: ONNX Runtime")
+        return load_onnx_session(ONNX_PATH)
+
+    return load_model(MODEL_PATH, device)
+
 
-    with torch.no_grad():
-        output = model(image_tensor)
+def predict_batch(model, image_paths, transform, device, batch_size=32):
+    """Predict scores for several images, batch_size images per forward pass.
 
-    # Convert to 0-100 scale
-    scores = (output.squeeze().cpu().numpy() * 100).tolist()
-    return {metric: round(score, 1) for metric, score in zip(METRICS, scores)}
+    model is either a FacialScoreModel or an ONNX Runtime session.
+    """
+    predictions = []
+    # Resize/normalize run where the model does; ONNX Runtime takes CPU input
+    target = device if isinstance(model, nn.Module) else torch.device("cpu")
+
+    # Decode every image on a thread pool (decode releases the GIL); later
+    # batches keep decoding while earlier ones run through the model
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as pool:
+        decoded = pool.map(load_image, image_paths)
+
+        for _ in range(0, len(image_paths), batch_size):
+            tensors = [
+                transform(image.to(target, non_blocking=True))
+                for image in islice(decoded, batch_size)
+            ]
+            predictions.extend(predict_tensors(model, torch.stack(tensors), device))
+
+    return predictions
+
+
+def predict_tensors(model, image_tensor, device):
+    """Scores for a preprocessed (N, 3, H, W) batch as a list of metric dicts."""
+    predictions = []
+
+    if isinstance(model, nn.Module):
+        image_tensor = image_tensor.contiguous(memory_format=torch.channels_last)
+        with torch.inference_mode(), torch.autocast(
+            device_type=device.type, dtype=get_autocast_dtype(device), enabled=device.type == "cuda"
+        ):
+            output = model(image_tensor)
+        output = output.float().cpu().numpy()
+    else:
+        # The export has a dynamic batch axis, so any chunk size works
+        output = model.run(["scores"], {"image": image_tensor.numpy()})[0]
+
+    for scores in (output * 100).tolist():  # Convert to 0-100 scale
+        predictions.append({metric: round(score, 1) for metric, score in zip(METRICS, scores)})
+
+    return predictions
+
+
+def predict_single_image(model, image_path, transform, device):
+    """Predict scores for a single image."""
+    return predict_batch(model, [image_path], transform, device)[0]
 
 
 def run_tests(num_samples=20):
@@ -131,7 +229,7 @@ def run_tests(num_samples=20):
     print(f"\nDevice: {device}")
 
     # Load model
-    model = load_model(MODEL_PATH, device)
+    model = load_predictor(device)
     transform = get_inference_transform()
 
     # Load ground truth scores
@@ -141,8 +239,7 @@ def run_tests(num_samples=20):
     scores_dict = data["scores"]
 
     # Get available images
-    image_files = [f for f in IMAGES_DIR.glob("*.jpg") if f.name in scores_dict]
-    image_files += [f for f in IMAGES_DIR.glob("*.png") if f.name in scores_dict]
+    image_files = get_scored_image_paths(scores_dict, IMAGES_DIR, SCORES_FILE)
 
     print(f"Total images available: {len(image_files)}")
 
@@ -153,43 +250,35 @@ def run_tests(num_samples=20):
 
     # Run predictions and compare
     print("-" * 70)
-    total_errors = {metric: 0 for metric in METRICS}
-    max_errors = {metric: 0 for metric in METRICS}
-
     results = []
-
-    for i, img_path in enumerate(test_images):
+    all_predictions = predict_batch(model, test_images, transform, device)
+
+    # Calculate errors for the whole test set at once, (N, NUM_METRICS)
+    gt_mat = np.array(
+        [[scores_dict[p.name].get(m, 50) for m in METRICS] for p in test_images], dtype=np.float32
+    )
+    pred_mat = np.array([[pred[m] for m in METRICS] for pred in all_predictions], dtype=np.float32)
+    err_mat = np.abs(gt_mat - pred_mat)
+    total_errors = err_mat.sum(axis=0)
+    max_errors = err_mat.max(axis=0)
+    avg_errors = err_mat.mean(axis=1)
+
+    for i, (img_path, predictions) in enumerate(zip(test_images, all_predictions)):
         filename = img_path.name
-        ground_truth = scores_dict[filename]
-        predictions = predict_single_image(model, img_path, transform, device)
-
-        # Calculate errors
-        errors = {}
-        for metric in METRICS:
-            gt = ground_truth.get(metric, 50)
-            pred = predictions[metric]
-            error = abs(gt - pred)
-            errors[metric] = error
-            total_errors[metric] += error
-            max_errors[metric] = max(max_errors[metric], error)
-
-        avg_error = sum(errors.values()) / len(errors)
+        avg_error = avg_errors[i]
         results.append({
             "filename": filename,
-            "avg_error": avg_error,
+            "avg_error": float(avg_error),
             "predictions": predictions,
-            "ground_truth": ground_truth,
-            "errors": errors
+            "ground_truth": scores_dict[filename],
+            "errors": dict(zip(METRICS, err_mat[i].tolist())),
         })
 
         # Print sample result
         print(f"\nSample {i+1}: {filename}")
         print(f"{'Metric':<20} {'Ground Truth':>12} {'Prediction':>12} {'Error':>8}")
         print("-" * 55)
-        for metric in METRICS:
-            gt = ground_truth.get(metric, 50)
-            pred = predictions[metric]
-            err = errors[metric]
+        for metric, gt, pred, err in zip(METRICS, gt_mat[i], pred_mat[i], err_mat[i]):
             status = "OK" if err < 10 else "WARN" if err < 15 else "BAD"
             print(f"{metric:<20} {gt:>12.1f} {pred:>12.1f} {err:>7.1f} {status}")
         print(f"{'Average Error':<20} {'':<12} {'':<12} {avg_error:>7.1f}")
@@ -203,15 +292,14 @@ def run_tests(num_samples=20):
     print("-" * 45)
 
     all_passed = True
-    for metric in METRICS:
-        mean_error = total_errors[metric] / len(test_images)
-        max_error = max_errors[metric]
+    for metric, metric_total, max_error in zip(METRICS, total_errors, max_errors):
+        mean_error = metric_total / len(test_images)
         status = "PASS" if mean_error < 10 else "WARN" if mean_error < 15 else "FAIL"
         if status == "FAIL":
             all_passed = False
         print(f"{metric:<20} {mean_error:>11.2f} {max_error:>11.2f}  [{status}]")
 
-    overall_mean = sum(total_errors.values()) / (len(METRICS) * len(test_images))
+    overall_mean = float(err_mat.mean())
     print("-" * 45)
     print(f"{'Overall':<20} {overall_mean:>11.2f}")
 
@@ -248,7 +336,7 @@ def test_single_image(image_path):
         return None
 
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-    model = load_model(MODEL_PATH, device)
+    model = load_predictor(device)
     transform = get_inference_transform()
 
     predictions = predict_single_image(model, image_path, transform, device)